@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Research Co-Pilot Cache Warmer
+Mine historical request logs for popular topics and pre-run the topic and
+literature steps for them, so the response cache is warm after a deploy
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from collections import Counter
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Iterable, Iterator, Tuple
+
+def _topics_in_record(record: Dict[str, Any]) -> Iterator[str]:
+    """Topics named by one log record.
+    
+    Understands plain JSONL access logs (``topic``), trace exports from
+    tracing.py (``attributes.topic`` on the record or any span) and the
+    request backlog format (``title``).
+    """
+    if isinstance(record.get('topic'), str):
+        yield record['topic']
+    attributes = record.get('attributes')
+    if isinstance(attributes, dict) and isinstance(attributes.get('topic'), str):
+        yield attributes['topic']
+    for item in record.get('spans') or []:
+        attributes = item.get('attributes') if isinstance(item, dict) else None
+        if isinstance(attributes, dict) and isinstance(attributes.get('topic'), str):
+            yield attributes['topic']
+    if isinstance(record.get('title'), str) and 'topic' not in record:
+        yield record['title']
+
+def mine_topics(paths: Iterable[str], limit: int = 20) -> List[Tuple[str, int]]:
+    """Most frequent topics across JSONL logs, as (topic, count) pairs.
+    
+    Topics are counted case- and whitespace-insensitively and reported with
+    their most common spelling. Lines that aren't JSON objects are skipped.
+    """
+    counts = Counter()
+    spellings = {}
+    for path in paths:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line.startswith('{'):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                for topic in set(_topics_in_record(record)):
+                    topic = ' '.join(topic.split())
+                    if not topic:
+                        continue
+                    key = topic.lower()
+                    counts[key] += 1
+                    spellings.setdefault(key, Counter())[topic] += 1
+    return [(spellings[key].most_common(1)[0][0], count) for key, count in counts.most_common(limit)]
+
+class QuotaBudget:
+    """Thread-safe allowance of LLM calls; a step only runs if its cost fits"""
+    
+    def __init__(self, max_calls: int):
+        self.max_calls = max_calls
+        self.spent = 0
+        self._lock = threading.Lock()
+    
+    def try_spend(self, calls: int) -> bool:
+        with self._lock:
+            if self.spent + calls > self.max_calls:
+                return False
+            self.spent += calls
+            return True
+    
+    def refund(self, calls: int):
+        with self._lock:
+            self.spent -= calls
+
+class SharedQuotaBudget:
+    """LLM call allowance shared by every process forked after it is created.
+    
+    A preforking server creates it in the master so all workers, including
+    ones recycled later, draw on the same quota. With ``window_seconds`` the
+    quota is renewed once per window; with 0 it is spent only once.
+    """
+    
+    def __init__(self, max_calls: int, window_seconds: float = 0):
+        self.max_calls = max_calls
+        self.window_seconds = window_seconds
+        self._lock = multiprocessing.Lock()
+        self._spent = multiprocessing.Value('i', 0, lock=False)
+        self._window_start = multiprocessing.Value('d', time.time(), lock=False)
+    
+    @property
+    def spent(self) -> int:
+        return self._spent.value
+    
+    def try_spend(self, calls: int) -> bool:
+        with self._lock:
+            now = time.time()
+            if self.window_seconds > 0 and now - self._window_start.value >= self.window_seconds:
+                self._window_start.value = now
+                self._spent.value = 0
+            if self._spent.value + calls > self.max_calls:
+                return False
+            self._spent.value += calls
+            return True
+
+@dataclass
+class WarmReport:
+    """What a warming run did and what it cost"""
+    topics_considered: int = 0
+    topics_warmed: int = 0
+    entries_warmed: int = 0
+    llm_calls: int = 0
+    budgeted_calls: int = 0
+    skipped_for_budget: int = 0
+    failures: List[str] = field(default_factory=list)
+    estimated_tokens: int = 0
+    wall_seconds: float = 0.0
+
+class LocalRunner:
+    """Warms the response cache of this process through the shared agents"""
+    
+    def __init__(self, pool=None):
+        from research_co_pilot import get_llm_pool, agent_response_cache, llm_priority
+        self.pool = pool or get_llm_pool()
+        self.cache = agent_response_cache
+        # Warming is batch traffic, so it never delays interactive LLM calls
+        self.priority = lambda: llm_priority('batch')
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
+    
+    def refine_topic(self, topic: str) -> List[str]:
+        with self.priority():
+            return self.pool.topic_agent.refine_topic(topic)['research_questions']
+    
+    def literature_cost(self, research_questions: List[str]) -> int:
+        agent = self.pool.literature_agent
+        return len(research_questions) if agent.map_reduce and len(research_questions) > 1 else 1
+    
+    def suggest_papers(self, topic: str, research_questions: List[str]):
+        with self.priority():
+            self.pool.literature_agent.suggest_papers(topic, research_questions, "")
+
+class RemoteRunner:
+    """Warms a running app's cache by walking its first two workflow steps over HTTP"""
+    
+    def __init__(self, base_url: str, timeout: float = 120.0):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.http.headers['X-Priority'] = 'batch'
+        self._local = threading.local()
+    
+    def _post(self, route: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        response = self.http.post(self.base_url + route, json=body, timeout=self.timeout)
+        data = response.json()
+        if response.status_code != 200 or not data.get('success'):
+            raise RuntimeError(f"{route} failed: {data.get('error', response.status_code)}")
+        return data
+    
+    def _session_body(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        body = dict(payload, session_id=self._local.session_id)
+        if self._local.context_token:
+            body['context_token'] = self._local.context_token
+        return body
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        metrics = self.http.get(self.base_url + '/api/metrics', timeout=self.timeout).json()
+        return metrics.get('response_cache') or {}
+    
+    def refine_topic(self, topic: str) -> List[str]:
+        data = self._post('/api/initialize', {})
+        self._local.session_id = data.get('session_id')
+        self._local.context_token = data.get('context_token')
+        data = self._post('/api/step1_topic', self._session_body({'topic': topic}))
+        self._local.context_token = data.get('context_token')
+        return data['research_questions']
+    
+    def literature_cost(self, research_questions: List[str]) -> int:
+        # The server may fan out one call per question, so budget for the worst case
+        return max(1, len(research_questions))
+    
+    def suggest_papers(self, topic: str, research_questions: List[str]):
+        self._post('/api/step2_literature', self._session_body({'clarifying_responses': {}}))
+
+class CacheWarmer:
+    """Pre-run the topic and literature steps for popular topics within a call budget.
+    
+    The literature step is warmed with empty clarifying answers, so it only
+    helps users who leave them blank (blank answers are dropped before the
+    prompt is rendered); the topic step depends on the topic alone.
+    """
+    
+    def __init__(self, runner, budget_calls: int = 100, concurrency: int = 4, shared_budget: SharedQuotaBudget = None):
+        self.runner = runner
+        self.budget = QuotaBudget(budget_calls)
+        # Across processes, a step also needs room in the shared quota
+        self.shared_budget = shared_budget
+        self.concurrency = max(1, concurrency)
+    
+    def _try_spend(self, calls: int) -> bool:
+        if not self.budget.try_spend(calls):
+            return False
+        if self.shared_budget is not None and not self.shared_budget.try_spend(calls):
+            self.budget.refund(calls)
+            return False
+        return True
+    
+    def warm(self, topics: List[str]) -> WarmReport:
+        report = WarmReport(topics_considered=len(topics))
+        lock = threading.Lock()
+        before = self.runner.cache_stats()
+        if not before.get('enabled'):
+            report.failures.append("Response cache is disabled; set COPILOT_RESPONSE_CACHE_SIZE")
+            return report
+        started = time.perf_counter()
+        
+        def warm_topic(topic: str):
+            try:
+                if not self._try_spend(1):
+                    with lock:
+                        report.skipped_for_budget += 1
+                    return
+                research_questions = self.runner.refine_topic(topic)
+                if self._try_spend(self.runner.literature_cost(research_questions)):
+                    self.runner.suggest_papers(topic, research_questions)
+                else:
+                    with lock:
+                        report.skipped_for_budget += 1
+                with lock:
+                    report.topics_warmed += 1
+            except Exception as e:
+                with lock:
+                    report.failures.append(f"{topic}: {e}")
+        
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='copilot-cache-warm') as executor:
+            list(executor.map(warm_topic, topics))
+        
+        after = self.runner.cache_stats()
+        report.wall_seconds = round(time.perf_counter() - started, 3)
+        report.budgeted_calls = self.budget.spent
+        report.entries_warmed = after.get('stores', 0) - before.get('stores', 0)
+        report.llm_calls = after.get('misses', 0) - before.get('misses', 0)
+        # Roughly four characters per token for prompts plus responses
+        chars = (after.get('prompt_chars', 0) - before.get('prompt_chars', 0)
+                 + after.get('response_chars', 0) - before.get('response_chars', 0))
+        report.estimated_tokens = chars // 4
+        return report
+
+def print_report(report: WarmReport):
+    print(f"🔥 Warmed {report.topics_warmed}/{report.topics_considered} topics, "
+          f"{report.entries_warmed} cache entries in {report.wall_seconds:.1f}s")
+    print(f"💰 Cost: {report.llm_calls} LLM calls (budgeted {report.budgeted_calls}), "
+          f"~{report.estimated_tokens} tokens")
+    if report.skipped_for_budget:
+        print(f"⏸️ {report.skipped_for_budget} steps skipped to stay within budget")
+    for failure in report.failures:
+        print(f"⚠️ {failure}")
+
+def warm_from_logs(paths: List[str], runner, top: int = 20, budget_calls: int = 100,
+                   concurrency: int = 4, shared_budget: SharedQuotaBudget = None) -> WarmReport:
+    """Mine the logs and warm the most frequent topics"""
+    topics = [topic for topic, _ in mine_topics(paths, limit=top)]
+    report = CacheWarmer(runner, budget_calls=budget_calls, concurrency=concurrency,
+                         shared_budget=shared_budget).warm(topics)
+    print_report(report)
+    return report
+
+def warming_enabled() -> bool:
+    return any(p.strip() for p in os.getenv('COPILOT_CACHE_WARM_LOGS', '').split(','))
+
+def shared_warm_budget() -> SharedQuotaBudget:
+    """The COPILOT_CACHE_WARM_BUDGET quota, renewed every COPILOT_CACHE_WARM_INTERVAL seconds,
+    to be created in a preforking master and shared by its workers"""
+    return SharedQuotaBudget(int(os.getenv('COPILOT_CACHE_WARM_BUDGET', '100')),
+                             float(os.getenv('COPILOT_CACHE_WARM_INTERVAL', '0')))
+
+def start_scheduled_warming(runner_factory=LocalRunner, shared_budget: SharedQuotaBudget = None, workers: int = 1):
+    """Warm this process's cache from COPILOT_CACHE_WARM_LOGS at startup and every
+    COPILOT_CACHE_WARM_INTERVAL seconds (0 means only once).
+    
+    Caches are per process, so each worker of a preforking server warms its
+    own, with an equal share of the budget. Passing the master's shared budget
+    keeps the total at COPILOT_CACHE_WARM_BUDGET per interval however many
+    workers run or get recycled.
+    """
+    paths = [p.strip() for p in os.getenv('COPILOT_CACHE_WARM_LOGS', '').split(',') if p.strip()]
+    if not paths:
+        return None
+    top = int(os.getenv('COPILOT_CACHE_WARM_TOPICS', '20'))
+    budget_calls = int(os.getenv('COPILOT_CACHE_WARM_BUDGET', '100')) // max(1, workers)
+    concurrency = int(os.getenv('COPILOT_CACHE_WARM_CONCURRENCY', '4'))
+    interval = float(os.getenv('COPILOT_CACHE_WARM_INTERVAL', '0'))
+    
+    def _run():
+        while True:
+            try:
+                warm_from_logs([p for p in paths if os.path.exists(p)], runner_factory(),
+                               top=top, budget_calls=budget_calls, concurrency=concurrency,
+                               shared_budget=shared_budget)
+            except Exception as e:
+                print(f"⚠️ Cache warming failed: {e}")
+            if interval <= 0:
+                return
+            time.sleep(interval)
+    
+    thread = threading.Thread(target=_run, name='cache-warmer', daemon=True)
+    thread.start()
+    return thread
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm the Research Co-Pilot response cache from request logs")
+    parser.add_argument('logs', nargs='+', help="JSONL request, access or trace logs to mine for topics")
+    parser.add_argument('--target', help="Base URL of the running app to warm (default: a cache in this process, only useful to measure cost)")
+    parser.add_argument('--top', type=int, default=20, help="Number of most frequent topics to warm")
+    parser.add_argument('--budget', type=int, default=100, help="Maximum LLM calls to spend")
+    parser.add_argument('--concurrency', type=int, default=4, help="Topics warmed in parallel")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the topics that would be warmed")
+    parser.add_argument('--json', dest='json_path', help="Also write the report as JSON to this path")
+    args = parser.parse_args(argv)
+    
+    topics = mine_topics(args.logs, limit=args.top)
+    print(f"📊 {len(topics)} popular topics found")
+    for topic, count in topics:
+        print(f"   {count:>5}  {topic}")
+    if args.dry_run:
+        return None
+    
+    runner = RemoteRunner(args.target) if args.target else LocalRunner()
+    report = CacheWarmer(runner, budget_calls=args.budget, concurrency=args.concurrency).warm(
+        [topic for topic, _ in topics]
+    )
+    print_report(report)
+    
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(asdict(report), f, indent=2)
+        print(f"💾 Report saved to: {args.json_path}")
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,33 +3,196 @@ Research Co-Pilot Web Frontend
 A beautiful, minimalistic web interface for the Research Co-Pilot system
 """
 
+import io
 import os
+import re
+import gzip
 import json
+import uuid
+import pstats
+import cProfile
 import tempfile
+import threading
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file, g, stream_with_context
 from dotenv import load_dotenv
 
 # Import the Research Co-Pilot
-from research_co_pilot import ResearchCoPilot
+from research_co_pilot import (ResearchCoPilot, get_llm_pool, get_llm_cassette, agent_singleflight, agent_breakers,
+                               agent_response_cache, llm_scheduler, set_llm_priority, reset_llm_priority,
+                               format_user_preferences)
+from session_store import SessionStore
+from tracing import start_span
+from context_token import ContextTokenCodec, ContextTokenError
+from text_delta import text_digest, compact_delta
+from export_bundle import stream_zip, session_members, bundle_filename
+from cache_warmer import start_scheduled_warming
+from latex_tools import latex_formats
+from pdf_builder import pdf_builder, PDF_WAIT_SECONDS
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 
-# Global variable to store the copilot instance
-copilot = None
+# Opt-in per-request profiling: requests with ?profile=1 or "X-Profile: 1" get a cProfile report
+PROFILING_ENABLED = os.getenv('COPILOT_PROFILING', '').lower() in ('1', 'true', 'yes')
+PROFILE_DIR = os.getenv('COPILOT_PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'copilot_profiles')
 
-def initialize_copilot():
-    """Initialize the Research Co-Pilot"""
-    global copilot
-    try:
-        copilot = ResearchCoPilot()
-        return True
-    except Exception as e:
-        print(f"Error initializing copilot: {e}")
-        return False
+# Live sessions keyed by session id; each shares the process-wide LLM pool
+session_store = SessionStore()
+
+# Stateless mode keeps no sessions: the client carries the context as a signed token
+STATELESS_MODE = os.getenv('COPILOT_STATELESS', '').lower() in ('1', 'true', 'yes')
+token_codec = ContextTokenCodec.from_env() if STATELESS_MODE else None
+
+# Set when a worker starts shutting down so load balancers stop routing to it
+draining = threading.Event()
+
+# Responses smaller than this aren't worth compressing
+GZIP_MIN_SIZE = int(os.getenv('COPILOT_GZIP_MIN_BYTES', '1024'))
+
+def create_session():
+    """Create a new session on top of the shared LLM pool and return its id"""
+    copilot = ResearchCoPilot(pool=get_llm_pool())
+    session_id = uuid.uuid4().hex
+    session_store.add(session_id, copilot)
+    return session_id
+
+def get_session_copilot():
+    """Check out the copilot for the session named in the request, if any"""
+    data = request.get_json(silent=True) or {}
+    if STATELESS_MODE:
+        token = data.get('context_token')
+        if not token:
+            return None
+        context = token_codec.decode(token, data.get('blobs'))
+        copilot = ResearchCoPilot(pool=get_llm_pool(), context=context)
+        # Pick up this worker's build of the paper, so a re-polish supersedes it as in session mode
+        copilot.pdf_build = pdf_builder.get(context.final_paper)
+        return copilot
+    
+    session_id = data.get('session_id') or request.headers.get('X-Session-Id')
+    if not session_id:
+        return None
+    copilot = session_store.acquire(session_id)
+    if copilot is not None:
+        g.setdefault('session_ids', []).append(session_id)
+    return copilot
+
+def session_response(copilot, payload):
+    """Successful step response; in stateless mode it also carries the updated context token"""
+    body = {'success': True}
+    body.update(payload)
+    if STATELESS_MODE:
+        token, refs = token_codec.encode(copilot.context)
+        body['context_token'] = token
+        if token_codec.blob_store is None:
+            # Large fields travel by reference; the client sends their text back as blobs
+            body['blob_refs'] = refs
+    return jsonify(body)
+
+@app.errorhandler(ContextTokenError)
+def handle_context_token_error(e):
+    """Reject requests whose context token can't be trusted or resolved"""
+    return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.teardown_request
+def release_sessions(exc):
+    """Hand checked-out sessions back to the store once the request is done"""
+    for session_id in g.pop('session_ids', []):
+        session_store.release(session_id)
+
+def save_profile(profiler):
+    """Store a request's cProfile data and a text summary; returns the report id"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    report_id = uuid.uuid4().hex
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{report_id}.prof"))
+    with open(os.path.join(PROFILE_DIR, f"{report_id}.txt"), 'w', encoding='utf-8') as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats('cumulative').print_stats(40)
+    return report_id
+
+@app.before_request
+def start_request_trace():
+    """Open the root tracing span and, if asked for, start profiling the request"""
+    g.trace_span = start_span(f"{request.method} {request.path}", route=request.path)
+    
+    wants_profile = request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+    if PROFILING_ENABLED and wants_profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profiler = profiler
+        except ValueError:
+            # Another profiler is already active in this process
+            pass
+
+@app.before_request
+def tag_llm_priority():
+    """Requests sent with "X-Priority: batch" queue their LLM calls behind interactive traffic"""
+    priority = request.headers.get('X-Priority', 'interactive').lower()
+    if priority not in llm_scheduler.CLASSES:
+        priority = 'interactive'
+    g.llm_priority_token = set_llm_priority(priority)
+
+@app.teardown_request
+def untag_llm_priority(exc):
+    """Restore the default priority so a reused worker thread starts clean"""
+    token = g.pop('llm_priority_token', None)
+    if token is not None:
+        reset_llm_priority(token)
+
+@app.after_request
+def attach_request_diagnostics(response):
+    """Stop profiling and point the client at the trace and profile report"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        response.headers['X-Profile-Report'] = f"/api/profiles/{save_profile(profiler)}"
+    trace_span = g.get('trace_span')
+    if trace_span is not None and trace_span.trace_id:
+        response.headers['X-Trace-Id'] = trace_span.trace_id
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Gzip JSON and HTML responses for clients that accept it"""
+    if (response.direct_passthrough
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in ('application/json', 'text/html')
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.teardown_request
+def finish_request_trace(exc):
+    """Close the root tracing span, exporting the trace"""
+    trace_span = g.pop('trace_span', None)
+    if trace_span is not None:
+        trace_span.finish(error=exc)
+
+def start_warmup():
+    """Warm the LLM pool in the background when COPILOT_WARMUP is enabled"""
+    if os.getenv('COPILOT_WARMUP', '').lower() not in ('1', 'true', 'yes'):
+        return None
+    
+    def _warm():
+        try:
+            get_llm_pool().warm_up()
+        except Exception as e:
+            print(f"⚠️ Warm-up skipped: {e}")
+    
+    thread = threading.Thread(target=_warm, name='llm-warmup', daemon=True)
+    thread.start()
+    return thread
 
 @app.route('/')
 def index():
@@ -38,20 +201,82 @@ def index():
 
 @app.route('/api/initialize', methods=['POST'])
 def initialize():
-    """Initialize the Research Co-Pilot"""
+    """Create a research session backed by the shared LLM pool"""
     try:
-        if initialize_copilot():
-            return jsonify({'success': True, 'message': 'Research Co-Pilot initialized successfully!'})
-        else:
-            return jsonify({'success': False, 'error': 'Failed to initialize Research Co-Pilot'}), 500
+        if STATELESS_MODE:
+            return session_response(ResearchCoPilot(pool=get_llm_pool()), {
+                'message': 'Research Co-Pilot initialized successfully!',
+                'session_id': None
+            })
+        
+        session_id = create_session()
+        return jsonify({
+            'success': True,
+            'message': 'Research Co-Pilot initialized successfully!',
+            'session_id': session_id
+        })
     except Exception as e:
+        print(f"Error initializing copilot: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/health', methods=['GET'])
+def health():
+    """Readiness probe for the shared LLM pool; pass ?deep=1 to check the LLM round-trip"""
+    try:
+        status = get_llm_pool().health(deep=request.args.get('deep') == '1')
+    except Exception as e:
+        return jsonify({'ready': False, 'error': str(e)}), 503
+    status['sessions'] = len(session_store)
+    status['open_breakers'] = [name for name, breaker in agent_breakers.stats().items() if breaker['state'] != 'closed']
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/healthz', methods=['GET'])
+def liveness():
+    """Liveness probe: the worker process is up and serving requests"""
+    return jsonify({'alive': True, 'pid': os.getpid()})
+
+@app.route('/readyz', methods=['GET'])
+def readiness():
+    """Readiness probe: the LLM pool is built and the worker isn't draining for shutdown"""
+    if draining.is_set():
+        return jsonify({'ready': False, 'draining': True}), 503
+    try:
+        status = get_llm_pool().health()
+    except Exception as e:
+        return jsonify({'ready': False, 'error': str(e)}), 503
+    return jsonify({'ready': status['ready'], 'draining': False}), 200 if status['ready'] else 503
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Runtime counters for the agent layer"""
+    cassette = get_llm_cassette()
+    return jsonify({
+        'singleflight': agent_singleflight.stats(),
+        'breakers': agent_breakers.stats(),
+        'response_cache': agent_response_cache.stats(),
+        'scheduler': llm_scheduler.stats(),
+        'latex_formats': latex_formats.stats(),
+        'pdf_builds': pdf_builder.stats(),
+        'sessions': session_store.stats(),
+        'cassette': cassette.stats() if cassette else None
+    })
+
+@app.route('/api/profiles/<report_id>', methods=['GET'])
+def get_profile(report_id):
+    """Return the text summary of a stored request profile"""
+    if not PROFILING_ENABLED:
+        return jsonify({'success': False, 'error': 'Profiling is disabled'}), 404
+    if not re.fullmatch(r'[0-9a-f]{32}', report_id):
+        return jsonify({'success': False, 'error': 'Invalid report id'}), 400
+    path = os.path.join(PROFILE_DIR, f"{report_id}.txt")
+    if not os.path.exists(path):
+        return jsonify({'success': False, 'error': 'Profile not found'}), 404
+    return send_file(path, mimetype='text/plain')
+
 @app.route('/api/start_workflow', methods=['POST'])
 def start_workflow():
     """Start the research workflow"""
-    global copilot
-    
+    copilot = get_session_copilot()
     if not copilot:
         return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
     
@@ -75,8 +300,7 @@ def start_workflow():
 @app.route('/api/step1_topic', methods=['POST'])
 def step1_topic():
     """Step 1: Topic Refinement"""
-    global copilot
-    
+    copilot = get_session_copilot()
     if not copilot:
         return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
     
@@ -87,13 +311,14 @@ def step1_topic():
         if not broad_topic:
             return jsonify({'success': False, 'error': 'No topic provided'}), 400
         
+        g.trace_span.set('topic', broad_topic)
+        
         # Run topic refinement
         topic_results = copilot.topic_agent.refine_topic(broad_topic)
         copilot.context.broad_topic = broad_topic
         copilot.context.research_questions = topic_results['research_questions']
         
-        return jsonify({
-            'success': True,
+        return session_response(copilot, {
             'research_questions': topic_results['research_questions'],
             'clarifying_questions': topic_results['clarifying_questions'],
             'analysis': topic_results['analysis']
@@ -105,8 +330,7 @@ def step1_topic():
 @app.route('/api/step2_literature', methods=['POST'])
 def step2_literature():
     """Step 2: Literature Review"""
-    global copilot
-    
+    copilot = get_session_copilot()
     if not copilot:
         return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
     
@@ -117,13 +341,23 @@ def step2_literature():
         research_questions = copilot.context.research_questions
         
         # Generate paper suggestions
-        user_preferences = " ".join([f"{k}: {v}" for k, v in clarifying_responses.items()])
-        paper_suggestions = copilot.literature_agent.suggest_papers(
+        user_preferences = format_user_preferences(clarifying_responses)
+        literature_agent = copilot.literature_agent
+        if literature_agent.map_reduce and len(research_questions) > 1:
+            search = literature_agent.map_reduce_search(topic, research_questions, user_preferences)
+            copilot.context.suggested_papers = search.papers
+            return session_response(copilot, {
+                'paper_suggestions': search.suggestions,
+                'papers': search.papers,
+                'coverage': search.coverage
+            })
+        
+        paper_suggestions = literature_agent.suggest_papers(
             topic, research_questions, user_preferences
         )
+        copilot.context.suggested_papers = []
         
-        return jsonify({
-            'success': True,
+        return session_response(copilot, {
             'paper_suggestions': paper_suggestions
         })
         
@@ -133,8 +367,7 @@ def step2_literature():
 @app.route('/api/step3_methodology', methods=['POST'])
 def step3_methodology():
     """Step 3: Methodology Design"""
-    global copilot
-    
+    copilot = get_session_copilot()
     if not copilot:
         return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
     
@@ -142,12 +375,12 @@ def step3_methodology():
         data = request.get_json()
         selected_papers = data.get('selected_papers', [])
         
-        # Mock paper data based on selection
-        mock_papers = [
+        # Papers parsed by a map-reduce search, otherwise mock paper data based on selection
+        candidate_papers = copilot.context.suggested_papers or [
             {"title": f"Relevant Paper {i+1}", "authors": f"Author {i+1}", "summary": f"Summary {i+1}"}
             for i in range(8)
         ]
-        copilot.context.selected_papers = [mock_papers[i] for i in selected_papers]
+        copilot.context.selected_papers = [candidate_papers[i] for i in selected_papers if 0 <= i < len(candidate_papers)]
         
         # Generate methodology suggestions
         methodology_suggestions = copilot.methodology_agent.suggest_methodology(
@@ -156,8 +389,7 @@ def step3_methodology():
             copilot.context.selected_papers
         )
         
-        return jsonify({
-            'success': True,
+        return session_response(copilot, {
             'methodology_suggestions': methodology_suggestions
         })
         
@@ -167,8 +399,7 @@ def step3_methodology():
 @app.route('/api/step4_draft', methods=['POST'])
 def step4_draft():
     """Step 4: Draft Generation"""
-    global copilot
-    
+    copilot = get_session_copilot()
     if not copilot:
         return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
     
@@ -188,9 +419,9 @@ def step4_draft():
         )
         copilot.context.draft_skeleton = draft_skeleton
         
-        return jsonify({
-            'success': True,
-            'draft_skeleton': draft_skeleton
+        return session_response(copilot, {
+            'draft_skeleton': draft_skeleton,
+            'draft_sha256': text_digest(draft_skeleton)
         })
         
     except Exception as e:
@@ -199,19 +430,35 @@ def step4_draft():
 @app.route('/api/step5_polish', methods=['POST'])
 def step5_polish():
     """Step 5: Polish and Finalize"""
-    global copilot
-    
+    copilot = get_session_copilot()
     if not copilot:
         return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
     
     try:
+        data = request.get_json(silent=True) or {}
+        draft_skeleton = copilot.context.draft_skeleton
+        
         # Polish the draft
-        final_paper = copilot.polish_agent.polish_paper(copilot.context.draft_skeleton)
+        final_paper = copilot.polish_agent.polish_paper(draft_skeleton)
         copilot.context.final_paper = final_paper
         
-        return jsonify({
-            'success': True,
-            'final_paper': final_paper
+        # Start compiling while the user reads the paper; a re-polish cancels the older build
+        build = copilot.start_pdf_build(eager=True)
+        pdf_status = build.describe() if build else None
+        
+        # A client that still holds the draft only needs the edits made to it
+        if data.get('delta_base') and data['delta_base'] == text_digest(draft_skeleton):
+            delta = compact_delta(draft_skeleton, final_paper)
+            if delta is not None:
+                return session_response(copilot, {
+                    'final_paper_delta': delta,
+                    'delta_base': data['delta_base'],
+                    'pdf_build': pdf_status
+                })
+        
+        return session_response(copilot, {
+            'final_paper': final_paper,
+            'pdf_build': pdf_status
         })
         
     except Exception as e:
@@ -220,8 +467,7 @@ def step5_polish():
 @app.route('/api/download_paper', methods=['POST'])
 def download_paper():
     """Download the final paper"""
-    global copilot
-    
+    copilot = get_session_copilot()
     if not copilot:
         return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
     
@@ -232,18 +478,115 @@ def download_paper():
         if not copilot.context.final_paper:
             return jsonify({'success': False, 'error': 'No paper generated yet'}), 400
         
-        # Save the paper
-        filename = copilot.save_paper()
+        build = None
+        if paper_type == 'pdf':
+            # Usually already built since polishing; otherwise this joins or starts the build
+            build = copilot.current_pdf_build() or copilot.start_pdf_build()
+            pdf_filename = build.wait(PDF_WAIT_SECONDS) if build else None
+            if pdf_filename:
+                print(f"📄 Returning PDF file: {pdf_filename}")
+                return send_file(pdf_filename, as_attachment=True, download_name='research_paper.pdf')
         
-        # Always return LaTeX file since PDF generation is not working
+        # LaTeX was asked for, or the PDF isn't available (yet). Sent from memory, so concurrent
+        # downloads never share (or leave behind) a file in the working directory
+        filename = f"research_paper_{datetime.now().strftime('%Y%m%d_%H%M%S')}.tex"
         print(f"📄 Returning LaTeX file: {filename}")
-        return send_file(filename, as_attachment=True, download_name=filename)
+        paper = io.BytesIO(copilot.context.final_paper.encode('utf-8'))
+        response = send_file(paper, mimetype='application/x-tex', as_attachment=True, download_name=filename)
+        if paper_type == 'pdf':
+            response.headers['X-PDF-Status'] = build.status if build else 'unavailable'
+        return response
         
     except Exception as e:
         print(f"❌ Download error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/pdf_status', methods=['POST'])
+def pdf_status():
+    """State of the background PDF build of the session's final paper"""
+    copilot = get_session_copilot()
+    if not copilot:
+        return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
+    
+    build = copilot.current_pdf_build()
+    return session_response(copilot, {'pdf_build': build.describe() if build else None})
+
+def zip_response(members):
+    """Stream a ZIP of bundle members as an attachment"""
+    filename = bundle_filename()
+    return Response(
+        stream_with_context(stream_zip(members)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@app.route('/api/export_bundle', methods=['POST'])
+def export_bundle():
+    """Stream a ZIP with the paper, bibliography, PDF (when it compiles) and research context"""
+    copilot = get_session_copilot()
+    if not copilot:
+        return jsonify({'success': False, 'error': 'Research Co-Pilot not initialized'}), 500
+    
+    data = request.get_json(silent=True) or {}
+    if not (copilot.context.final_paper or copilot.context.draft_skeleton):
+        return jsonify({'success': False, 'error': 'No paper generated yet'}), 400
+    
+    response = zip_response(session_members(copilot, include_pdf=data.get('include_pdf', True)))
+    if not STATELESS_MODE:
+        # The request's checkout ends at teardown, before the ZIP streams, and an idle session
+        # may be packed; hold it until the response is closed instead
+        session_id = g.session_ids[-1]
+        session_store.acquire(session_id)
+        response.call_on_close(lambda: session_store.release(session_id))
+    return response
+
+@app.route('/api/export_bundles', methods=['POST'])
+def export_bundles():
+    """Batch export: one folder per session in a single streamed ZIP, for archival jobs"""
+    data = request.get_json(silent=True) or {}
+    include_pdf = data.get('include_pdf', False)
+    
+    if STATELESS_MODE:
+        # Decode every token up front so a bad one is rejected before streaming starts
+        copilots = []
+        for number, item in enumerate(data.get('contexts') or [], start=1):
+            context = token_codec.decode(item.get('context_token'), item.get('blobs'))
+            copilots.append((f"session_{number}", ResearchCoPilot(pool=get_llm_pool(), context=context)))
+        if not copilots:
+            return jsonify({'success': False, 'error': 'No sessions to export'}), 400
+        
+        def batch_members():
+            for name, copilot in copilots:
+                yield from session_members(copilot, prefix=f"{name}/", include_pdf=include_pdf)
+            yield 'manifest.json', json.dumps({'exported': [name for name, _ in copilots], 'missing': []}, indent=2)
+        
+        return zip_response(batch_members())
+    
+    session_ids = data.get('session_ids') or []
+    if not session_ids:
+        return jsonify({'success': False, 'error': 'No sessions to export'}), 400
+    
+    def batch_members():
+        # Check sessions out one at a time so packed sessions are only restored while streamed
+        exported, missing = [], []
+        for session_id in session_ids:
+            copilot = session_store.acquire(session_id)
+            if copilot is None:
+                missing.append(session_id)
+                continue
+            try:
+                yield from session_members(copilot, prefix=f"{session_id}/", include_pdf=include_pdf)
+                exported.append(session_id)
+            finally:
+                session_store.release(session_id)
+        yield 'manifest.json', json.dumps({'exported': exported, 'missing': missing}, indent=2)
+    
+    return zip_response(batch_members())
+
 if __name__ == '__main__':
     print("🚀 Starting Research Agent Web Frontend...")
     print("📱 Open your browser and go to: http://localhost:5003")
-    app.run(debug=True, host='0.0.0.0', port=5003)
+    start_warmup()
+    start_scheduled_warming()
+    # Development server only; use serve.py for production
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=5003)
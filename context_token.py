@@ -0,0 +1,148 @@
+"""
+Research Co-Pilot Context Tokens
+Serialize a ResearchContext into a compact, compressed and HMAC-signed token so
+that any stateless instance can resume a session from what the client sends back
+"""
+
+import os
+import hmac
+import json
+import time
+import zlib
+import base64
+import hashlib
+from dataclasses import asdict
+from typing import Dict, Tuple, Optional
+
+from research_co_pilot import ResearchContext
+
+TOKEN_VERSION = 'v1'
+
+class ContextTokenError(ValueError):
+    """Raised when a token is malformed, tampered with, expired or missing blobs"""
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def blob_ref(text: str) -> str:
+    """Content address of a large field"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class BlobStore:
+    """Optional shared directory of content-addressed blobs (e.g. a mounted volume)"""
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, ref: str) -> str:
+        return os.path.join(self.directory, f"{ref}.z")
+    
+    def put(self, ref: str, text: str):
+        path = self._path(ref)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(text.encode('utf-8')))
+        os.replace(tmp_path, path)
+    
+    def get(self, ref: str) -> Optional[str]:
+        try:
+            with open(self._path(ref), 'rb') as f:
+                return zlib.decompress(f.read()).decode('utf-8')
+        except OSError:
+            return None
+
+class ContextTokenCodec:
+    """Encode and decode signed context tokens.
+    
+    Token layout: ``v1.<base64url(zlib(json))>.<base64url(hmac-sha256)>``.
+    Text fields at or above ``inline_limit`` characters are replaced by their
+    SHA-256 content address; the text itself travels separately, either in a
+    shared BlobStore or in the ``blobs`` map the client sends back, and is
+    verified against the address on decode.
+    """
+    
+    LARGE_FIELDS = ('draft_skeleton', 'final_paper')
+    
+    def __init__(self, secret: bytes, max_age: float = 86400, inline_limit: int = 1024,
+                 blob_store: BlobStore = None):
+        self.secret = secret
+        self.max_age = max_age
+        self.inline_limit = inline_limit
+        self.blob_store = blob_store
+    
+    @classmethod
+    def from_env(cls) -> 'ContextTokenCodec':
+        """Build a codec from COPILOT_TOKEN_SECRET, COPILOT_TOKEN_MAX_AGE and COPILOT_BLOB_DIR"""
+        secret = os.getenv('COPILOT_TOKEN_SECRET')
+        if not secret:
+            print("⚠️ COPILOT_TOKEN_SECRET not set; context tokens only work on this instance")
+            secret = os.urandom(32).hex()
+        blob_dir = os.getenv('COPILOT_BLOB_DIR')
+        return cls(
+            secret.encode('utf-8'),
+            max_age=float(os.getenv('COPILOT_TOKEN_MAX_AGE', '86400')),
+            blob_store=BlobStore(blob_dir) if blob_dir else None
+        )
+    
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.secret, TOKEN_VERSION.encode('ascii') + b'.' + payload, hashlib.sha256).digest()
+    
+    def encode(self, context: ResearchContext) -> Tuple[str, Dict[str, str]]:
+        """Return the token and a map of field name -> blob ref for fields stored by reference"""
+        data = asdict(context)
+        refs = {}
+        for field in self.LARGE_FIELDS:
+            text = data[field]
+            if len(text) >= self.inline_limit:
+                ref = blob_ref(text)
+                if self.blob_store is not None:
+                    self.blob_store.put(ref, text)
+                data[field] = {'$ref': ref}
+                refs[field] = ref
+        
+        body = {'iat': int(time.time()), 'ctx': data}
+        payload = zlib.compress(json.dumps(body, separators=(',', ':')).encode('utf-8'), 9)
+        token = f"{TOKEN_VERSION}.{_b64encode(payload)}.{_b64encode(self._sign(payload))}"
+        return token, refs
+    
+    def decode(self, token: str, blobs: Dict[str, str] = None) -> ResearchContext:
+        """Verify a token and rebuild its context, resolving blob refs"""
+        try:
+            version, payload_text, signature_text = token.split('.')
+            payload = _b64decode(payload_text)
+            signature = _b64decode(signature_text)
+        except (ValueError, AttributeError) as e:
+            raise ContextTokenError("Malformed context token") from e
+        if version != TOKEN_VERSION:
+            raise ContextTokenError(f"Unsupported context token version: {version}")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            raise ContextTokenError("Invalid context token signature")
+        
+        body = json.loads(zlib.decompress(payload))
+        if self.max_age and time.time() - body['iat'] > self.max_age:
+            raise ContextTokenError("Context token expired")
+        
+        if not isinstance(blobs, dict):
+            blobs = {}
+        data = body['ctx']
+        for field in self.LARGE_FIELDS:
+            value = data.get(field)
+            if isinstance(value, dict):
+                data[field] = self._resolve(value['$ref'], blobs)
+        return ResearchContext(**data)
+    
+    def _resolve(self, ref: str, blobs: Dict[str, str]) -> str:
+        text = blobs.get(ref)
+        if text is None and self.blob_store is not None:
+            text = self.blob_store.get(ref)
+        if text is None:
+            raise ContextTokenError(f"Missing context blob {ref[:12]}")
+        if blob_ref(text) != ref:
+            raise ContextTokenError(f"Context blob {ref[:12]} does not match its reference")
+        return text
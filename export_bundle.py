@@ -0,0 +1,141 @@
+"""
+Research Co-Pilot Export Bundles
+Stream a ZIP of a session's artifacts (.tex, .bib, PDF, context JSON) chunk by chunk
+"""
+
+import os
+import re
+import json
+import shutil
+import zipfile
+import tempfile
+from datetime import datetime
+from typing import Iterable, Iterator, Tuple, Union
+
+from pdf_builder import PDF_WAIT_SECONDS
+
+# A bundle member: archive name and its content, either whole or as chunks
+Member = Tuple[str, Union[str, bytes, Iterable[bytes]]]
+
+CHUNK_SIZE = 64 * 1024
+
+# Characters that have to be escaped inside a BibTeX field
+_BIBTEX_SPECIAL_RE = re.compile(r'([&%$#_{}])')
+
+class _ChunkSink:
+    """Write-only, unseekable file object that collects what ZipFile writes until drained"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(members: Iterable[Member]) -> Iterator[bytes]:
+    """Yield a ZIP archive of members as it is built.
+    
+    Writing to an unseekable sink makes ZipFile emit data descriptors instead
+    of seeking back to patch headers, so only the chunk being compressed is
+    held in memory and nothing touches the disk.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members:
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            if isinstance(content, bytes):
+                content = (content,)
+            with archive.open(name, 'w') as entry:
+                for chunk in content:
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            # Closing the entry flushes the compressor and writes its data descriptor
+            data = sink.drain()
+            if data:
+                yield data
+    # Closing the archive writes the central directory
+    yield sink.drain()
+
+def _read_file(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk
+
+def _bibtex_escape(value) -> str:
+    return _BIBTEX_SPECIAL_RE.sub(r'\\\1', str(value))
+
+def generate_bibtex(selected_papers) -> str:
+    """BibTeX entries for the selected papers, keyed paper1..paperN like the draft's \\bibitem keys"""
+    entries = []
+    for number, paper in enumerate(selected_papers, start=1):
+        fields = [
+            ('title', paper.get('title', f"Paper {number}")),
+            ('author', paper.get('authors', 'Unknown')),
+            ('year', paper.get('year', datetime.now().year))
+        ]
+        for optional in ('journal', 'booktitle', 'doi', 'url'):
+            if paper.get(optional):
+                fields.append((optional, paper[optional]))
+        if paper.get('summary'):
+            fields.append(('note', paper['summary']))
+        body = ",\n".join(f"  {name} = {{{_bibtex_escape(value)}}}" for name, value in fields)
+        entries.append(f"@article{{paper{number},\n{body}\n}}\n")
+    return "\n".join(entries)
+
+def context_manifest(context) -> str:
+    """JSON dump of the research decisions behind a paper"""
+    return json.dumps({
+        'exported_at': datetime.now().isoformat(),
+        'broad_topic': context.broad_topic,
+        'research_questions': context.research_questions,
+        'selected_papers': context.selected_papers,
+        'methodology_preferences': context.methodology_preferences
+    }, indent=2)
+
+def pdf_available() -> bool:
+    return shutil.which('pdflatex') is not None
+
+def session_members(copilot, prefix: str = '', include_pdf: bool = True) -> Iterator[Member]:
+    """Bundle members for one session.
+    
+    The PDF is only included when pdflatex is installed and the paper compiles.
+    The background build started at polishing is reused, waiting up to
+    COPILOT_PDF_WAIT_SECONDS for it, and a failed build is not retried. Only
+    without one is the paper compiled here, in a scratch directory removed
+    once streamed.
+    """
+    context = copilot.context
+    paper = context.final_paper or context.draft_skeleton
+    yield f"{prefix}paper.tex", paper
+    yield f"{prefix}references.bib", generate_bibtex(context.selected_papers)
+    yield f"{prefix}context.json", context_manifest(context)
+    
+    if include_pdf and paper and pdf_available():
+        build = copilot.current_pdf_build() if paper == context.final_paper else None
+        if build is not None:
+            pdf_path = build.wait(PDF_WAIT_SECONDS)
+            if pdf_path:
+                yield f"{prefix}paper.pdf", _read_file(pdf_path)
+            return
+        with tempfile.TemporaryDirectory(prefix='copilot_export_') as build_dir:
+            tex_filename = os.path.join(build_dir, 'paper.tex')
+            with open(tex_filename, 'w', encoding='utf-8') as f:
+                f.write(paper)
+            result = copilot.generate_pdf(tex_filename)
+            if result.endswith('.pdf'):
+                yield f"{prefix}paper.pdf", _read_file(result)
+
+def bundle_filename() -> str:
+    return f"research_bundle_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
@@ -0,0 +1,377 @@
+"""
+Research Co-Pilot LaTeX Tools
+Fast structural checks for LLM-generated LaTeX before it is compiled or served,
+and precompiled preamble formats that make compiling it cheaper
+"""
+
+import os
+import re
+import hashlib
+import tempfile
+import threading
+import subprocess
+from itertools import accumulate
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+# Packages we know a standard TeX Live install provides; others only produce a warning
+KNOWN_PACKAGES = {
+    'algorithm', 'algorithmic', 'algorithm2e', 'algpseudocode', 'amsfonts', 'amsmath', 'amssymb',
+    'amsthm', 'authblk', 'babel', 'biblatex', 'booktabs', 'caption', 'cite', 'cleveref', 'color',
+    'csquotes', 'enumerate', 'enumitem', 'fancyhdr', 'float', 'fontenc', 'geometry', 'graphicx',
+    'hyperref', 'inputenc', 'lipsum', 'listings', 'lmodern', 'longtable', 'makecell', 'mathtools',
+    'microtype', 'multicol', 'multirow', 'natbib', 'parskip', 'pgfplots', 'setspace', 'siunitx',
+    'subcaption', 'subfig', 'tabularx', 'textcomp', 'tikz', 'times', 'titlesec', 'titling',
+    'tocloft', 'url', 'verbatim', 'wrapfig', 'xcolor', 'xspace'
+}
+
+# Environments whose bodies are not parsed as LaTeX
+VERBATIM_ENVIRONMENTS = {'verbatim', 'verbatim*', 'lstlisting', 'minted', 'comment'}
+
+# One alternation covering every structural token, scanned left to right. Plain braces
+# between these tokens are counted in bulk, and other commands need no inspection at all.
+# Verbatim environments, URL arguments and \verb/\lstinline bodies are matched whole and
+# ahead of everything else, so a '%' or brace inside them is neither a comment nor counted.
+_TOKEN_RE = re.compile(
+    r'\\begin\s*\{(?P<verbatim>verbatim\*?|lstlisting|minted|comment)\}[\s\S]*?\\end\s*\{(?P=verbatim)\}'
+    r'|\\verb\*?(?P<delim>[^a-zA-Z\s])[^\n]*?(?P=delim)'
+    r'|\\lstinline\s*(?:\[[^\]\n]*\])?(?P<ldelim>[^a-zA-Z\s\[{])[^\n]*?(?P=ldelim)'
+    r'|\\(?P<kind>begin|end)\s*\{(?P<env>[^{}]*)\}'
+    r'|\\usepackage\s*(?:\[[^\]]*\])?\s*\{(?P<packages>[^{}]*)\}'
+    r'|\\documentclass\b'
+    r'|\\(?:url|nolinkurl|href)\s*\{[^{}\n]*\}'
+    r'|\\[^a-zA-Z]'
+    r'|%[^\n]*'
+)
+
+_NON_BRACE_RE = re.compile(r'[^{}]+')
+_BRACE_DELTA = {'{': 1, '}': -1}
+
+_CODE_FENCE_RE = re.compile(r'^\s*```[a-zA-Z]*\s*\n|\n\s*```\s*$')
+
+@dataclass
+class LatexValidationResult:
+    """Outcome of validating (and possibly repairing) a LaTeX document"""
+    document: str
+    errors: List[str] = field(default_factory=list)
+    warnings: List[str] = field(default_factory=list)
+    repairs: List[str] = field(default_factory=list)
+    
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+def _count_braces(segment: str, depth: int, result: LatexValidationResult) -> int:
+    """Apply the braces of a token-free segment to the running depth, flagging underflow"""
+    braces = _NON_BRACE_RE.sub('', segment)
+    if not braces:
+        return depth
+    lowest = min(accumulate(map(_BRACE_DELTA.__getitem__, braces), initial=depth))
+    depth += 2 * braces.count('{') - len(braces)
+    if lowest < 0:
+        result.errors.append("Unbalanced braces: unexpected '}'")
+        depth -= lowest
+    return depth
+
+def validate_latex(source: str, repair: bool = True) -> LatexValidationResult:
+    """Check brace balance, environment nesting, document markers and packages in one pass.
+    
+    With ``repair`` enabled, trivially fixable problems are fixed in the
+    returned document: surrounding Markdown code fences, chatter before
+    ``\\documentclass`` or after ``\\end{document}``, and environments left
+    open at the end of the file (including a missing ``\\end{document}``).
+    Anything else is reported in ``errors``.
+    """
+    result = LatexValidationResult(document=source)
+    text = source
+    
+    if repair:
+        unfenced = _CODE_FENCE_RE.sub('', text)
+        if unfenced != text:
+            text = unfenced
+            result.repairs.append("Removed Markdown code fences")
+        start = text.find('\\documentclass')
+        if start > 0 and text[:start].strip():
+            text = text[start:]
+            result.repairs.append("Removed text before \\documentclass")
+    
+    depth = 0
+    env_stack = []
+    document_classes = 0
+    begin_document = False
+    end_document_at = None
+    skip_until = 0
+    gap_start = 0
+    
+    for match in _TOKEN_RE.finditer(text):
+        if match.start() < skip_until:
+            continue
+        depth = _count_braces(text[gap_start:match.start()], depth, result)
+        gap_start = match.end()
+        token = match.group(0)
+        
+        kind = match.group('kind')
+        if kind is not None:
+            env = match.group('env').strip()
+            if kind == 'begin':
+                if env == 'document':
+                    begin_document = True
+                env_stack.append(env)
+                if env in VERBATIM_ENVIRONMENTS:
+                    # Only reached when the environment is never closed: skip the rest
+                    close = text.find(f'\\end{{{env}}}', match.end())
+                    skip_until = gap_start = close if close != -1 else len(text)
+            elif not env_stack:
+                result.errors.append(f"\\end{{{env}}} without matching \\begin")
+            elif env_stack[-1] != env:
+                result.errors.append(f"\\end{{{env}}} closes \\begin{{{env_stack[-1]}}}")
+                env_stack.pop()
+            else:
+                env_stack.pop()
+                if env == 'document':
+                    end_document_at = match.end()
+                    break
+        elif match.group('packages') is not None:
+            for package in match.group('packages').split(','):
+                package = package.strip()
+                if package and package not in KNOWN_PACKAGES:
+                    result.warnings.append(f"Unknown package: {package}")
+        elif token == '\\documentclass':
+            document_classes += 1
+    else:
+        depth = _count_braces(text[gap_start:], depth, result)
+    
+    if document_classes == 0:
+        result.errors.append("Missing \\documentclass")
+    elif document_classes > 1:
+        result.errors.append("More than one \\documentclass")
+    if not begin_document:
+        result.errors.append("Missing \\begin{document}")
+    if depth > 0:
+        result.errors.append(f"Unbalanced braces: {depth} unclosed '{{'")
+    
+    if end_document_at is not None:
+        trailing = text[end_document_at:]
+        if trailing.strip():
+            if repair:
+                text = text[:end_document_at] + '\n'
+                result.repairs.append("Removed text after \\end{document}")
+            else:
+                result.warnings.append("Text after \\end{document}")
+    elif begin_document and not result.errors:
+        if repair:
+            closing = ''.join(f"\\end{{{env}}}\n" for env in reversed(env_stack))
+            text = text.rstrip() + '\n' + closing
+            result.repairs.append(f"Closed open environments: {', '.join(reversed(env_stack))}")
+        else:
+            result.errors.append("Missing \\end{document}")
+    elif begin_document:
+        result.errors.append("Missing \\end{document}")
+    
+    result.document = text
+    return result
+
+# Document classes whose preambles can be dumped into a precompiled format
+FORMAT_DOCUMENT_CLASSES = {'article', 'report', 'book', 'amsart', 'extarticle'}
+
+# Preamble commands that pull in files the preamble hash can't see
+_UNCACHEABLE_PREAMBLE_RE = re.compile(r'\\(?:input|include|InputIfFileExists)\b')
+_DOCUMENT_CLASS_RE = re.compile(r'\\documentclass\s*(?:\[[^\]]*\])?\s*\{([^{}]*)\}')
+_PACKAGES_RE = re.compile(r'\\usepackage\s*(?:\[[^\]]*\])?\s*\{([^{}]*)\}')
+
+# Preamble lines from here on describe one paper, so they are run on every compile instead of dumped
+_PER_DOCUMENT_RE = re.compile(r'^[ \t]*\\(?:title|author|date|thanks)\b', re.MULTILINE)
+
+# Where mylatexformat stops skipping the preamble when a format is loaded; \relax in a plain compile
+END_OF_DUMP = '\\csname endofdump\\endcsname\n'
+
+def split_preamble(source: str) -> Tuple[str, str]:
+    """Split a document at \\begin{document}; the preamble is empty if there is none"""
+    index = source.find('\\begin{document}')
+    if index == -1:
+        return '', source
+    return source[:index], source[index:]
+
+def split_dumpable(preamble: str) -> Tuple[str, str]:
+    """Split a preamble before its first \\title/\\author/\\date line: the shared setup, then the per-paper part"""
+    match = _PER_DOCUMENT_RE.search(preamble)
+    if match is None:
+        return preamble, ''
+    return preamble[:match.start()], preamble[match.start():]
+
+def preamble_is_cacheable(preamble: str) -> bool:
+    """Whether a preamble only uses a standard class and known packages, so a format built from it is safe to reuse"""
+    document_class = _DOCUMENT_CLASS_RE.search(preamble)
+    if document_class is None or document_class.group(1).strip() not in FORMAT_DOCUMENT_CLASSES:
+        return False
+    if _UNCACHEABLE_PREAMBLE_RE.search(preamble):
+        return False
+    for match in _PACKAGES_RE.finditer(preamble):
+        if any(package.strip() not in KNOWN_PACKAGES for package in match.group(1).split(',') if package.strip()):
+            return False
+    return True
+
+class PreambleFormatCache:
+    """Precompiled pdflatex formats for common preambles, keyed by preamble hash.
+    
+    A format is built once per distinct preamble with mylatexformat and kept
+    in ``directory``. Only the setup before the first \\title, \\author or
+    \\date line is dumped and hashed, so papers that differ only in their
+    title share one format; the rest runs on every compile after an
+    end-of-dump marker. Documents compiled against it skip re-reading the
+    packages on every pass. At most ``max_formats`` are kept, least recently
+    used first out. Custom preambles, a missing mylatexformat or a failed
+    build all fall back to a plain compile.
+    """
+    
+    def __init__(self, directory: str = None, timeout: float = 120.0, enabled: bool = None, max_formats: int = None):
+        if enabled is None:
+            enabled = os.getenv('COPILOT_LATEX_FORMATS', '1').lower() not in ('0', 'false', 'no')
+        self.enabled = enabled
+        self.directory = directory or os.getenv('COPILOT_LATEX_FORMAT_DIR') or os.path.join(
+            tempfile.gettempdir(), 'copilot_latex_formats'
+        )
+        self.timeout = timeout
+        self.max_formats = max(1, max_formats or int(os.getenv('COPILOT_LATEX_FORMATS_KEPT', '16')))
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._failed = set()
+        self.builds = 0
+        self.hits = 0
+        self.fallbacks = 0
+    
+    @staticmethod
+    def key_for(preamble: str) -> str:
+        return 'copilot_' + hashlib.sha256(preamble.strip().encode('utf-8')).hexdigest()[:16]
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.fmt")
+    
+    def format_for(self, source: str) -> Optional[str]:
+        """Name of a format matching the document's preamble, building it on first use; None to compile plainly"""
+        if not self.enabled:
+            return None
+        preamble, _ = split_preamble(source)
+        setup, _ = split_dumpable(preamble)
+        if not setup or not preamble_is_cacheable(setup):
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        key = self.key_for(setup)
+        with self._lock:
+            if key in self._failed:
+                self.fallbacks += 1
+                return None
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        
+        # One build per preamble; concurrent compiles of the same preamble wait for it
+        try:
+            with build_lock:
+                if self._touch(key):
+                    with self._lock:
+                        self.hits += 1
+                    return key
+                built = self._build(key, setup)
+        finally:
+            with self._lock:
+                # Only needed while a build is in flight; later callers find the .fmt instead
+                if self._build_locks.get(key) is build_lock:
+                    del self._build_locks[key]
+        with self._lock:
+            if built:
+                self.builds += 1
+            else:
+                self._failed.add(key)
+                self.fallbacks += 1
+        if built:
+            self._prune()
+        return key if built else None
+    
+    @staticmethod
+    def source_for_format(source: str) -> str:
+        """The document with an end-of-dump marker after the dumped setup, for compiling against its format"""
+        preamble, body = split_preamble(source)
+        setup, per_document = split_dumpable(preamble)
+        if not per_document:
+            # Nothing after the setup, so \\begin{document} already ends the skipped part
+            return source
+        return setup + END_OF_DUMP + per_document + body
+    
+    def _touch(self, key: str) -> bool:
+        """Mark a format as used for pruning; False if it doesn't exist"""
+        try:
+            os.utime(self._path(key))
+            return True
+        except OSError:
+            return False
+    
+    def _prune(self):
+        """Remove the least recently used formats beyond max_formats"""
+        try:
+            formats = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.fmt')]
+        except OSError:
+            return
+        if len(formats) <= self.max_formats:
+            return
+        formats.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in formats[:len(formats) - self.max_formats]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    
+    def _build(self, key: str, preamble: str) -> bool:
+        """Dump the preamble into <key>.fmt with mylatexformat"""
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.directory) as build_dir:
+            with open(os.path.join(build_dir, f"{key}.tex"), 'w', encoding='utf-8') as f:
+                f.write(preamble + '\\begin{document}\n\\end{document}\n')
+            try:
+                subprocess.run([
+                    'pdflatex', '-ini', '-interaction=nonstopmode', f'-jobname={key}',
+                    '&pdflatex', 'mylatexformat.ltx', f'{key}.tex'
+                ], cwd=build_dir, capture_output=True, text=True, timeout=self.timeout)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                print(f"⚠️ LaTeX format build failed: {e}")
+                return False
+            built = os.path.join(build_dir, f"{key}.fmt")
+            if not os.path.exists(built):
+                print("⚠️ LaTeX format build produced no .fmt (is mylatexformat installed?), compiling without it")
+                return False
+            # Atomic, so other processes never load a half-written format
+            os.replace(built, self._path(key))
+        print(f"📦 Built LaTeX preamble format {key}")
+        return True
+    
+    def invalidate(self, key: str):
+        """Drop a format that failed to load, e.g. after a TeX upgrade"""
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            # Already pruned (possibly by another process) rather than broken, so it may be rebuilt
+            return
+        with self._lock:
+            self._failed.add(key)
+    
+    def environment(self) -> Dict[str, str]:
+        """Subprocess environment that lets pdflatex find the cached formats"""
+        # The trailing separator keeps the default format search path as well
+        return dict(os.environ, TEXFORMATS=self.directory + os.pathsep)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'enabled': self.enabled, 'builds': self.builds, 'hits': self.hits, 'fallbacks': self.fallbacks}
+
+# Messages in a pdflatex log that mean another pass would change the output
+_RERUN_RE = re.compile(r'Rerun to get|Label\(s\) may have changed|There were undefined (?:references|citations)')
+
+def needs_rerun(log_path: str) -> bool:
+    """Whether the last pdflatex pass left unresolved references or changed labels"""
+    try:
+        with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+            return _RERUN_RE.search(f.read()) is not None
+    except OSError:
+        # Without a log we can't tell, so take the safe second pass
+        return True
+
+latex_formats = PreambleFormatCache()
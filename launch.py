@@ -28,8 +28,19 @@ def launch_web():
     print()
     
     try:
-        from launch_co_pilot_web import app
-        app.run(debug=True, host='0.0.0.0', port=5002)
+        import serve
+    except ImportError:
+        # gunicorn isn't available (e.g. on Windows), so fall back to Flask's development server
+        serve = None
+    
+    try:
+        if serve is not None:
+            serve.main(sys.argv[1:])
+        else:
+            print("⚠️ gunicorn not installed; using the single-process development server")
+            from co_pilot_web import app, start_warmup
+            start_warmup()
+            app.run(host='0.0.0.0', port=5003)
     except ImportError as e:
         print(f"❌ Error: {e}")
         print("Please make sure all dependencies are installed:")
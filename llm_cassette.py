@@ -0,0 +1,171 @@
+"""
+Research Co-Pilot LLM Cassettes
+Record LLM prompt/response pairs to a cassette file and replay them offline
+"""
+
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+from typing import Dict, List, Any, Optional
+
+class CassetteMissError(KeyError):
+    """Raised in replay mode when a prompt was never recorded"""
+
+class LLMCassette:
+    """Append-only JSONL cassette of LLM calls with an offset index for fast replay.
+    
+    Each line holds one call: the prompt key, the agent name, the original
+    latency and the response text. A sidecar ``.idx`` file maps every key to
+    the byte offsets of its records, so opening a large cassette only reads
+    the index and each replayed response is fetched with a single seek.
+    Identical prompts recorded several times are replayed in recording order.
+    The index is written when a recording is closed; a missing or stale index
+    is rebuilt with one scan of the cassette.
+    """
+    
+    MODES = ('record', 'replay')
+    
+    def __init__(self, path: str, mode: str = 'replay', realtime: bool = False):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self._lock = threading.Lock()
+        self._index = {}
+        self._replay_positions = {}
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        
+        if mode == 'replay':
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Cassette not found: {path}")
+            self._index = self._load_index()
+            self._reader = open(path, 'rb')
+        else:
+            # Recording appends to an existing cassette, so keep its index current
+            if os.path.exists(path):
+                self._index = self._load_index()
+            self._writer = open(path, 'ab')
+    
+    @classmethod
+    def from_env(cls) -> Optional['LLMCassette']:
+        """Build a cassette from COPILOT_CASSETTE / _MODE / _LATENCY, or None if unset"""
+        path = os.getenv('COPILOT_CASSETTE')
+        if not path:
+            return None
+        mode = os.getenv('COPILOT_CASSETTE_MODE', 'replay')
+        realtime = os.getenv('COPILOT_CASSETTE_LATENCY', 'zero') == 'original'
+        cassette = cls(path, mode=mode, realtime=realtime)
+        atexit.register(cassette.close)
+        return cassette
+    
+    @staticmethod
+    def key_for(agent: str, prompt: str) -> str:
+        """Stable key for an agent's rendered prompt"""
+        return hashlib.sha256(f"{agent}\0{prompt}".encode('utf-8')).hexdigest()
+    
+    @property
+    def index_path(self) -> str:
+        return self.path + '.idx'
+    
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._index.values())
+    
+    def replay(self, agent: str, prompt: str) -> str:
+        """Return the recorded response for this prompt, sleeping for its latency if realtime"""
+        key = self.key_for(agent, prompt)
+        with self._lock:
+            entries = self._index.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMissError(f"No recorded {agent} response for prompt {key[:12]}")
+            position = self._replay_positions.get(key, 0)
+            # Repeat the last recording once every recorded response has been served
+            offset, length, latency_ms = entries[min(position, len(entries) - 1)]
+            self._replay_positions[key] = position + 1
+            self._reader.seek(offset)
+            record = json.loads(self._reader.read(length))
+            self.hits += 1
+        if self.realtime and latency_ms:
+            time.sleep(latency_ms / 1000)
+        return record['response']
+    
+    def record(self, agent: str, prompt: str, response: str, latency_seconds: float):
+        """Append a prompt/response pair with its timing metadata"""
+        key = self.key_for(agent, prompt)
+        latency_ms = round(latency_seconds * 1000, 1)
+        line = json.dumps({
+            'key': key,
+            'agent': agent,
+            'prompt_chars': len(prompt),
+            'latency_ms': latency_ms,
+            'recorded_at': time.time(),
+            'response': response
+        }, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            self._writer.seek(0, os.SEEK_END)
+            offset = self._writer.tell()
+            self._writer.write(line + b'\n')
+            self._writer.flush()
+            self._index.setdefault(key, []).append([offset, len(line), latency_ms])
+            self.recorded += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'entries': sum(len(entries) for entries in self._index.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'recorded': self.recorded
+            }
+    
+    def close(self):
+        """Close the cassette, persisting the index of a recording"""
+        with self._lock:
+            if self.mode == 'replay':
+                self._reader.close()
+            elif not self._writer.closed:
+                self._writer.close()
+                self._save_index()
+    
+    def _load_index(self) -> Dict[str, List[list]]:
+        """Read the sidecar index, rebuilding it if it is missing or stale"""
+        try:
+            if os.path.getmtime(self.index_path) >= os.path.getmtime(self.path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+        return self._rebuild_index()
+    
+    def _rebuild_index(self) -> Dict[str, List[list]]:
+        """Scan the cassette once to recover record offsets"""
+        index = {}
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                stripped = line.rstrip(b'\n')
+                if stripped:
+                    record = json.loads(stripped)
+                    index.setdefault(record['key'], []).append([offset, len(stripped), record.get('latency_ms', 0)])
+                offset += len(line)
+        self._index = index
+        try:
+            self._save_index()
+        except OSError:
+            # A read-only cassette can still be replayed from the in-memory index
+            pass
+        return index
+    
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
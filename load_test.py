@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Research Co-Pilot Load Test
+Drives simulated users through the web workflow against a local stand-in
+Gemini server and reports throughput, per-route latency percentiles and errors
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from typing import Dict, List, Any
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Canned LLM responses, picked by looking at which agent's prompt was sent
+FAKE_TOPIC_RESPONSE = """RESEARCH_QUESTIONS:
+- How does the approach perform on real-world benchmarks?
+- Which factors limit its scalability?
+- How robust is it to distribution shift?
+
+CLARIFYING_QUESTIONS:
+- Which application domain matters most to you?
+- Are you targeting theoretical or empirical contributions?
+
+ANALYSIS:
+These questions cover performance, scalability and robustness of the topic."""
+
+FAKE_LITERATURE_RESPONSE = """PAPER_SUGGESTIONS:
+Paper 1: A Survey of the Field
+Authors: A. Author, B. Author
+Summary: A broad survey of existing methods.
+Relevance: Establishes the state of the art.
+
+Paper 2: Scaling Laws Revisited
+Authors: C. Author
+Summary: Studies how performance scales with data and compute.
+Relevance: Informs the scalability question.
+
+SELECTION_GUIDE:
+Select the papers closest to your research questions."""
+
+FAKE_METHODOLOGY_RESPONSE = """DATASET_SUGGESTIONS:
+- Benchmark A: Standard benchmark for the task
+
+EVALUATION_METRICS:
+- Accuracy: Primary quality measure
+
+EXPERIMENTAL_DESIGN:
+Compare the proposed approach with strong baselines across three seeds.
+
+USER_PREFERENCES_QUESTIONS:
+- What experiment scale do you prefer?"""
+
+FAKE_LATEX_RESPONSE = """\\documentclass[12pt,a4paper]{article}
+\\usepackage{amsmath}
+\\title{Load Test Paper}
+\\begin{document}
+\\maketitle
+\\begin{abstract}
+Synthetic abstract used for load testing.
+\\end{abstract}
+\\section{Introduction}
+""" + "Synthetic body text for load testing. " * 200 + """
+\\end{document}"""
+
+def fake_response_for(prompt: str) -> str:
+    """Choose a canned response matching the agent that produced the prompt"""
+    if 'topic refinement specialist' in prompt:
+        return FAKE_TOPIC_RESPONSE
+    if 'literature review specialist' in prompt:
+        return FAKE_LITERATURE_RESPONSE
+    if 'methodology specialist' in prompt:
+        return FAKE_METHODOLOGY_RESPONSE
+    if 'LaTeX' in prompt:
+        return FAKE_LATEX_RESPONSE
+    return "ready"
+
+def parse_latency(spec: str):
+    """Parse a latency distribution spec into a sampler returning seconds.
+    
+    Supported specs (milliseconds): "200", "uniform:100:400",
+    "normal:300:50" and "lognormal:300:0.5" (median and sigma).
+    """
+    parts = spec.split(':')
+    kind = parts[0]
+    if len(parts) == 1:
+        value = float(kind) / 1000
+        return lambda: value
+    a, b = float(parts[1]), float(parts[2])
+    if kind == 'uniform':
+        return lambda: random.uniform(a, b) / 1000
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(a, b)) / 1000
+    if kind == 'lognormal':
+        mu = math.log(a)
+        return lambda: random.lognormvariate(mu, b) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+class FakeGeminiServer:
+    """Local stand-in for the Gemini REST API with configurable latency and errors"""
+    
+    def __init__(self, latency: str = '500', error_rate: float = 0.0,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                prompt = "\n".join(
+                    part.get('text', '')
+                    for content in body.get('contents', [])
+                    for part in content.get('parts', [])
+                )
+                time.sleep(server.sample_latency())
+                
+                with server._lock:
+                    server.calls += 1
+                    failed = random.random() < server.error_rate
+                    if failed:
+                        server.errors += 1
+                
+                if failed:
+                    status = 500
+                    payload = {'error': {'code': 500, 'message': 'Injected failure', 'status': 'INTERNAL'}}
+                else:
+                    status = 200
+                    text = fake_response_for(prompt)
+                    payload = {
+                        'candidates': [{
+                            'content': {'parts': [{'text': text}], 'role': 'model'},
+                            'finishReason': 'STOP',
+                            'index': 0
+                        }],
+                        'usageMetadata': {
+                            'promptTokenCount': len(prompt) // 4,
+                            'candidatesTokenCount': len(text) // 4,
+                            'totalTokenCount': (len(prompt) + len(text)) // 4
+                        }
+                    }
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-gemini', daemon=True)
+    
+    @property
+    def endpoint(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def start_local_app(llm_endpoint: str, port: int = 0):
+    """Serve co_pilot_web in-process on a threaded server pointed at the fake LLM"""
+    os.environ['GEMINI_API_ENDPOINT'] = llm_endpoint
+    os.environ.setdefault('GEMINI_API_KEY', 'load-test')
+    # Keep anything the app writes to the working directory out of the repo
+    os.chdir(tempfile.mkdtemp(prefix='copilot_load_'))
+    
+    from werkzeug.serving import make_server
+    from co_pilot_web import app
+    
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    httpd = make_server('127.0.0.1', port, app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, name='copilot-app', daemon=True)
+    thread.start()
+    return httpd, f"http://127.0.0.1:{httpd.server_port}"
+
+class Recorder:
+    """Thread-safe collection of per-route request outcomes"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.flows_completed = 0
+    
+    def record(self, route: str, seconds: float, ok: bool):
+        with self._lock:
+            self.samples.setdefault(route, []).append((seconds, ok))
+    
+    def flow_done(self):
+        with self._lock:
+            self.flows_completed += 1
+
+def run_user_flow(base_url: str, http: requests.Session, recorder: Recorder, topic: str,
+                  timeout: float, label: str = '') -> bool:
+    """Walk one simulated user through every workflow step; returns True if all succeeded.
+    
+    Like the browser, it sends back the context token and blobs of the last
+    response, so the flow also works against a server in stateless mode.
+    """
+    steps = [
+        ('/api/initialize', {}),
+        ('/api/step1_topic', {'topic': topic}),
+        ('/api/step2_literature', {'clarifying_responses': {'q1': 'empirical'}}),
+        ('/api/step3_methodology', {'selected_papers': [0, 1, 2]}),
+        ('/api/step4_draft', {'methodology_preferences': {'pref_1': 'medium'}}),
+        ('/api/step5_polish', {}),
+        ('/api/download_paper', {'type': 'tex'}),
+    ]
+    session_id = None
+    context_token = None
+    blobs = {}
+    for route, payload in steps:
+        body = dict(payload)
+        if route != '/api/initialize':
+            body['session_id'] = session_id
+            if context_token:
+                body['context_token'] = context_token
+                body['blobs'] = blobs
+        start = time.perf_counter()
+        try:
+            response = http.post(base_url + route, json=body, timeout=timeout)
+            ok = response.status_code == 200
+            if ok and response.headers.get('Content-Type', '').startswith('application/json'):
+                data = response.json()
+                session_id = data.get('session_id', session_id)
+                if data.get('context_token'):
+                    context_token = data['context_token']
+                    # Large fields come back once in full and travel by reference afterwards
+                    blobs = {ref: data[field] if field in data else blobs.get(ref)
+                             for field, ref in (data.get('blob_refs') or {}).items()}
+        except requests.RequestException:
+            ok = False
+        recorder.record(label + route, time.perf_counter() - start, ok)
+        if not ok:
+            return False
+    recorder.flow_done()
+    return True
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+def run_stage(base_url: str, users: int, duration: float, ramp_seconds: float,
+              topics: List[str], timeout: float, batch_users: int = 0) -> Dict[str, Any]:
+    """Run `users` concurrent looping users (plus `batch_users` tagged as batch) for `duration` seconds and summarize"""
+    recorder = Recorder()
+    stop_at = time.time() + duration
+    
+    def user_loop(index: int, batch: bool = False):
+        if ramp_seconds:
+            time.sleep(ramp_seconds * index / users)
+        http = requests.Session()
+        label = ''
+        if batch:
+            # Batch users' LLM calls queue behind interactive ones; report them separately
+            http.headers['X-Priority'] = 'batch'
+            label = '[batch] '
+        while time.time() < stop_at:
+            run_user_flow(base_url, http, recorder, topics[index % len(topics)], timeout, label)
+    
+    started = time.time()
+    threads = [threading.Thread(target=user_loop, args=(i,), daemon=True) for i in range(users)]
+    threads += [threading.Thread(target=user_loop, args=(i, True), daemon=True) for i in range(batch_users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    
+    routes = {}
+    total = errors = 0
+    for route, samples in recorder.samples.items():
+        latencies = sorted(seconds for seconds, _ in samples)
+        failed = sum(1 for _, ok in samples if not ok)
+        total += len(samples)
+        errors += failed
+        routes[route] = {
+            'requests': len(samples),
+            'error_rate': round(failed / len(samples), 4),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1)
+        }
+    
+    return {
+        'users': users,
+        'batch_users': batch_users,
+        'duration_seconds': round(elapsed, 2),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else 0.0,
+        'flows_completed': recorder.flows_completed,
+        'flows_per_second': round(recorder.flows_completed / elapsed, 3) if elapsed else 0.0,
+        'error_rate': round(errors / total, 4) if total else 0.0,
+        'routes': routes
+    }
+
+def parse_stages(spec: str):
+    """Parse a ramp profile like "5:30,10:30,20:30" into (users, seconds) stages"""
+    stages = []
+    for item in spec.split(','):
+        users, seconds = item.split(':')
+        stages.append((int(users), float(seconds)))
+    return stages
+
+def find_saturation(results: List[Dict[str, Any]], min_gain: float = 0.05):
+    """Return the first stage whose added users stopped buying throughput"""
+    for previous, current in zip(results, results[1:]):
+        if previous['throughput_rps'] and current['throughput_rps'] < previous['throughput_rps'] * (1 + min_gain):
+            return previous['users']
+    return None
+
+def print_stage_report(result: Dict[str, Any]):
+    batch = f" + {result['batch_users']} batch" if result.get('batch_users') else ''
+    print(f"\n👥 {result['users']} users{batch} for {result['duration_seconds']}s: "
+          f"{result['throughput_rps']} req/s, {result['flows_per_second']} flows/s, "
+          f"error rate {result['error_rate']:.2%}")
+    print(f"   {'route':<34}{'reqs':>7}{'err%':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in sorted(result['routes'].items()):
+        print(f"   {route:<34}{stats['requests']:>7}{stats['error_rate'] * 100:>7.1f}%"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Research Co-Pilot web app")
+    parser.add_argument('--target', help="Base URL of an already running app (default: start one in-process)")
+    parser.add_argument('--stages', default='5:30', help="Ramp profile as users:seconds pairs, e.g. 5:30,10:30,20:30")
+    parser.add_argument('--ramp-seconds', type=float, default=0.0, help="Stagger user start-up within each stage")
+    parser.add_argument('--latency', default='500', help="Fake LLM latency in ms: 200, uniform:a:b, normal:mu:sd, lognormal:median:sigma")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of fake LLM calls that fail")
+    parser.add_argument('--llm-port', type=int, default=0, help="Port for the fake LLM server (default: random)")
+    parser.add_argument('--topics', default='Machine learning for climate modeling',
+                        help="Comma-separated topics assigned round-robin to users")
+    parser.add_argument('--batch-users', type=int, default=0,
+                        help="Extra users per stage sending X-Priority: batch, to check interactive latency under batch load")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument('--json', dest='json_path', help="Also write the report as JSON to this path")
+    args = parser.parse_args(argv)
+    if args.json_path:
+        # The in-process app changes directory, so pin the report path first
+        args.json_path = os.path.abspath(args.json_path)
+    
+    fake_llm = FakeGeminiServer(args.latency, args.error_rate, port=args.llm_port).start()
+    print(f"🤖 Fake Gemini server listening on {fake_llm.endpoint}")
+    
+    app_server = None
+    if args.target:
+        base_url = args.target.rstrip('/')
+        print(f"🎯 Targeting {base_url}; start it with GEMINI_API_ENDPOINT={fake_llm.endpoint}")
+    else:
+        app_server, base_url = start_local_app(fake_llm.endpoint)
+        print(f"🌐 Research Co-Pilot serving in-process on {base_url}")
+    
+    topics = [t.strip() for t in args.topics.split(',') if t.strip()]
+    results = []
+    try:
+        for users, seconds in parse_stages(args.stages):
+            result = run_stage(base_url, users, seconds, args.ramp_seconds, topics, args.timeout, args.batch_users)
+            print_stage_report(result)
+            results.append(result)
+    finally:
+        if app_server is not None:
+            app_server.shutdown()
+        fake_llm.stop()
+    
+    saturation = find_saturation(results)
+    report = {
+        'stages': results,
+        'saturation_users': saturation,
+        'llm_calls': fake_llm.calls,
+        'llm_errors': fake_llm.errors
+    }
+    print(f"\n🤖 Fake LLM served {fake_llm.calls} calls ({fake_llm.errors} injected errors)")
+    if saturation is not None:
+        print(f"📈 Throughput saturates at about {saturation} concurrent users")
+    
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Report saved to: {args.json_path}")
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
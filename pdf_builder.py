@@ -0,0 +1,222 @@
+"""
+Research Co-Pilot Background PDF Builds
+Compile a finished paper while the user is still reading it, so the download
+only has to pick up the PDF
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# How long a download or export waits for a background build that is still running
+PDF_WAIT_SECONDS = float(os.getenv('COPILOT_PDF_WAIT_SECONDS', '10'))
+
+# Build states; the last three are final
+QUEUED, RUNNING, READY, FAILED, CANCELLED = 'queued', 'running', 'ready', 'failed', 'cancelled'
+
+class PdfBuildCancelled(Exception):
+    """Raised inside a compile whose build was superseded, to stop before the next pass"""
+
+class PdfBuild:
+    """One background compile of one revision of a paper"""
+    
+    def __init__(self, digest: str):
+        self.digest = digest
+        self.status = QUEUED
+        self.pdf_path = None
+        self.error = None
+        self.build_dir = None
+        self.future = None
+        # Sessions whose current revision this is; the build is cancelled when none are left
+        self.holders = 1
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.queued_at = time.time()
+        self.finished_at = None
+    
+    @property
+    def done(self) -> bool:
+        return self.finished.is_set()
+    
+    def wait(self, timeout: float = None) -> Optional[str]:
+        """Wait up to timeout seconds for the build; returns the PDF path if it succeeded"""
+        self.finished.wait(timeout)
+        if self.status == READY and self.pdf_path and os.path.exists(self.pdf_path):
+            return self.pdf_path
+        return None
+    
+    def describe(self) -> Dict[str, Any]:
+        info = {'status': self.status, 'sha256': self.digest}
+        if self.finished_at:
+            info['build_seconds'] = round(self.finished_at - self.queued_at, 3)
+        if self.error:
+            info['error'] = self.error
+        return info
+
+class PdfBuilder:
+    """Runs PDF builds on a small thread pool, one per distinct paper text.
+    
+    Builds are keyed by the SHA-256 of the paper, so sessions (or stateless
+    requests) holding the same text share one build. Submitting a new revision
+    for a session releases its previous build, which is cancelled once no
+    session holds it: before it starts if it is still queued, otherwise
+    between pdflatex passes. Finished builds are kept up to ``max_builds``,
+    oldest first out, and their scratch directories removed on eviction.
+    
+    Builds live in one process. With ``eager`` off, papers are only compiled
+    when a download asks for them, not as soon as they are polished.
+    """
+    
+    def __init__(self, max_workers: int = 2, max_builds: int = 128, eager: bool = True):
+        self.max_workers = max(1, max_workers)
+        self.max_builds = max(1, max_builds)
+        self.eager = eager
+        self._lock = threading.Lock()
+        self._builds = OrderedDict()
+        self._executor = None
+        self.submitted = 0
+        self.shared = 0
+        self.cancellations = 0
+    
+    @classmethod
+    def from_env(cls) -> 'PdfBuilder':
+        return cls(
+            max_workers=int(os.getenv('COPILOT_PDF_WORKERS', '2')),
+            max_builds=int(os.getenv('COPILOT_PDF_BUILDS_KEPT', '128')),
+            eager=os.getenv('COPILOT_EAGER_PDF', '1').lower() not in ('0', 'false', 'no')
+        )
+    
+    def available(self) -> bool:
+        # Never fall into the compiler's texlive auto-install from a background thread
+        return shutil.which('pdflatex') is not None
+    
+    @staticmethod
+    def digest(paper: str) -> str:
+        return hashlib.sha256(paper.encode('utf-8')).hexdigest()
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created on first use, so a preforking server starts the threads in each worker
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='copilot-pdf')
+        return self._executor
+    
+    def get(self, paper: str) -> Optional[PdfBuild]:
+        """The build for this exact paper text, if one is known"""
+        if not paper:
+            return None
+        with self._lock:
+            return self._builds.get(self.digest(paper))
+    
+    def submit(self, paper: str, compile_fn: Callable, previous: PdfBuild = None) -> Optional[PdfBuild]:
+        """Start (or join) a build of paper and release the previous revision's build.
+        
+        compile_fn(tex_filename, cancelled=event) follows ResearchCoPilot.generate_pdf:
+        it returns the PDF path on success and anything else on failure.
+        """
+        if not paper or not self.available():
+            return None
+        digest = self.digest(paper)
+        evicted = []
+        with self._lock:
+            build = self._builds.get(digest)
+            # A failed build stays failed: the same text would fail the same way
+            if build is not None and build.status != CANCELLED:
+                self._builds.move_to_end(digest)
+                if build is not previous:
+                    build.holders += 1
+                    self.shared += 1
+            else:
+                build = PdfBuild(digest)
+                self._builds[digest] = build
+                self.submitted += 1
+                build.future = self._get_executor().submit(self._run, build, paper, compile_fn)
+                while len(self._builds) > self.max_builds:
+                    evicted.append(self._builds.popitem(last=False)[1])
+        
+        if previous is not None and previous is not build:
+            self.release(previous)
+        for old in evicted:
+            self._cancel(old)
+        return build
+    
+    def release(self, build: PdfBuild):
+        """A session moved on from this build; cancel it if nobody else holds it"""
+        with self._lock:
+            build.holders -= 1
+            if build.holders > 0:
+                return
+            if self._builds.get(build.digest) is build:
+                del self._builds[build.digest]
+        self._cancel(build)
+    
+    def _cancel(self, build: PdfBuild):
+        build.cancelled.set()
+        with self._lock:
+            if not build.done:
+                self.cancellations += 1
+            if build.future is not None and build.future.cancel():
+                # Never started, so nobody else will finish it
+                self._finish(build, CANCELLED)
+            elif build.done:
+                self._remove_files(build)
+    
+    def _run(self, build: PdfBuild, paper: str, compile_fn: Callable):
+        if build.cancelled.is_set():
+            with self._lock:
+                self._finish(build, CANCELLED)
+            return
+        build.status = RUNNING
+        build.build_dir = tempfile.mkdtemp(prefix='copilot_pdf_')
+        tex_filename = os.path.join(build.build_dir, 'paper.tex')
+        try:
+            with open(tex_filename, 'w', encoding='utf-8') as f:
+                f.write(paper)
+            result = compile_fn(tex_filename, cancelled=build.cancelled)
+        except Exception as e:
+            result = None
+            build.error = str(e)
+        
+        with self._lock:
+            if build.cancelled.is_set():
+                self._finish(build, CANCELLED)
+                self._remove_files(build)
+            elif isinstance(result, str) and result.endswith('.pdf'):
+                build.pdf_path = result
+                self._finish(build, READY)
+            else:
+                self._finish(build, FAILED)
+                self._remove_files(build)
+        if build.status == READY:
+            print(f"📄 Background PDF ready: {build.pdf_path}")
+    
+    def _finish(self, build: PdfBuild, status: str):
+        build.status = status
+        build.finished_at = time.time()
+        build.finished.set()
+    
+    def _remove_files(self, build: PdfBuild):
+        if build.build_dir:
+            shutil.rmtree(build.build_dir, ignore_errors=True)
+            build.build_dir = None
+            build.pdf_path = None
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            by_status = {}
+            for build in self._builds.values():
+                by_status[build.status] = by_status.get(build.status, 0) + 1
+            return {
+                'eager': self.eager,
+                'submitted': self.submitted,
+                'shared': self.shared,
+                'cancelled': self.cancellations,
+                'builds': by_status
+            }
+
+pdf_builder = PdfBuilder.from_env()
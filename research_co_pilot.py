@@ -4,10 +4,19 @@ Built with LangChain to help users brainstorm and draft research papers
 """
 
 import os
+import re
 import subprocess
+import shutil
 import json
+import hashlib
+import threading
+import time
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from typing import Dict, List, Any, Optional
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 
 # LangChain imports
@@ -21,12 +30,18 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 load_dotenv()
 
+from tracing import span
+from llm_cassette import LLMCassette
+from latex_tools import validate_latex, latex_formats, needs_rerun
+from pdf_builder import pdf_builder, PdfBuildCancelled, CANCELLED
+
 @dataclass
 class ResearchContext:
     """Data structure to hold research context across agents"""
     broad_topic: str = ""
     research_questions: List[str] = None
     selected_papers: List[Dict] = None
+    suggested_papers: List[Dict] = None
     methodology_preferences: Dict = None
     draft_skeleton: str = ""
     final_paper: str = ""
@@ -36,10 +51,619 @@ class ResearchContext:
             self.research_questions = []
         if self.selected_papers is None:
             self.selected_papers = []
+        if self.suggested_papers is None:
+            self.suggested_papers = []
         if self.methodology_preferences is None:
             self.methodology_preferences = {}
 
-class TopicAgent:
+class SingleFlight:
+    """Coalesce concurrent identical calls so only one of them does the work.
+
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait for it and receive the same result or exception.
+    """
+    
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.executed = 0
+        self.coalesced = 0
+    
+    def do(self, key, fn):
+        """Run fn for key, or wait for the identical call already in flight"""
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = self._Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Counters for executed vs coalesced calls"""
+        with self._lock:
+            total = self.executed + self.coalesced
+            return {
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._in_flight),
+                'coalesce_rate': round(self.coalesced / total, 4) if total else 0.0
+            }
+
+# Shared by every agent so identical prompts from concurrent sessions hit the LLM once
+agent_singleflight = SingleFlight()
+
+class LLMUnavailableError(RuntimeError):
+    """The LLM call was not made or not finished in time; callers may serve a fallback"""
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised without calling the LLM while an agent's circuit breaker is open"""
+
+class DeadlineExceededError(LLMUnavailableError):
+    """Raised when an LLM call runs past its agent's deadline"""
+
+class CircuitBreaker:
+    """Per-agent breaker that stops calling a failing or slow LLM.
+
+    ``failure_threshold`` consecutive errors or deadline misses open the
+    breaker; while open, calls fail immediately with CircuitOpenError. After
+    ``reset_timeout`` seconds it half-opens and lets a single probe call
+    through: success closes it again, failure re-opens it.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, name: str, deadline: float = None, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.saturated = 0
+        self.fallbacks = 0
+        self.last_error = None
+    
+    def allow(self) -> bool:
+        """Whether a call may go to the LLM now; half-open admits one probe at a time"""
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+    
+    def check_open(self):
+        """Raise CircuitOpenError if allow() would refuse now, without taking the half-open probe"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                return
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"{self.name} circuit is open; LLM calls are paused")
+    
+    def record_success(self):
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                print(f"✅ Circuit breaker for {self.name} closed")
+            self.state = self.CLOSED
+    
+    def record_failure(self, error: BaseException, timeout: bool = False):
+        with self._lock:
+            self.failures += 1
+            if timeout:
+                self.timeouts += 1
+            self.consecutive_failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"⚠️ Circuit breaker for {self.name} opened: {self.last_error}")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+    
+    def record_saturated(self):
+        """A call that never got an executor thread: not the LLM's fault, so no failure is counted"""
+        with self._lock:
+            self.saturated += 1
+            self._probe_in_flight = False
+    
+    def record_fallback(self):
+        with self._lock:
+            self.fallbacks += 1
+    
+    def call(self, fn):
+        """Run fn under the breaker, enforcing the deadline"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open; LLM calls are paused")
+        future = None
+        if self.deadline:
+            started = threading.Event()
+            
+            def run():
+                started.set()
+                return fn()
+            
+            # Run on the LLM executor so the request thread can give up at the deadline.
+            # The deadline starts when the call does: waiting for a free executor thread
+            # is saturation on our side, not a slow LLM. That wait is bounded by the
+            # deadline too, in case every thread is held by a hung call.
+            future = _llm_executor.submit(contextvars.copy_context().run, run)
+            if not started.wait(self.deadline) and future.cancel():
+                self.record_saturated()
+                raise LLMUnavailableError(f"No free LLM thread for {self.name} within {self.deadline:g}s")
+        try:
+            result = future.result(timeout=self.deadline) if future is not None else fn()
+        except FutureTimeoutError:
+            error = DeadlineExceededError(f"{self.name} LLM call exceeded its {self.deadline:g}s deadline")
+            self.record_failure(error, timeout=True)
+            raise error
+        except BaseException as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'deadline_seconds': self.deadline,
+                'consecutive_failures': self.consecutive_failures,
+                'successes': self.successes,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'saturated': self.saturated,
+                'fallbacks': self.fallbacks,
+                'last_error': self.last_error
+            }
+
+class CircuitBreakerRegistry:
+    """One breaker per agent, configured from the environment.
+    
+    COPILOT_BREAKER_DEADLINE sets the default per-call deadline in seconds
+    (0 disables it) and COPILOT_BREAKER_DEADLINES overrides it per agent,
+    e.g. ``DraftingAgent=90,PolishAgent=90``. COPILOT_BREAKER_FAILURES and
+    COPILOT_BREAKER_RESET_SECONDS set the opening threshold and the time
+    before a half-open probe.
+    """
+    
+    def __init__(self, deadline: float = None, deadlines: Dict[str, float] = None,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.deadline = deadline
+        self.deadlines = deadlines or {}
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._breakers = {}
+    
+    @classmethod
+    def from_env(cls) -> 'CircuitBreakerRegistry':
+        deadlines = {'DraftingAgent': 90.0, 'PolishAgent': 90.0}
+        for item in os.getenv('COPILOT_BREAKER_DEADLINES', '').split(','):
+            if '=' in item:
+                agent_name, seconds = item.split('=', 1)
+                deadlines[agent_name.strip()] = float(seconds)
+        return cls(
+            deadline=float(os.getenv('COPILOT_BREAKER_DEADLINE', '30')),
+            deadlines=deadlines,
+            failure_threshold=int(os.getenv('COPILOT_BREAKER_FAILURES', '5')),
+            reset_timeout=float(os.getenv('COPILOT_BREAKER_RESET_SECONDS', '30'))
+        )
+    
+    def get(self, agent_name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(agent_name)
+            if breaker is None:
+                deadline = self.deadlines.get(agent_name, self.deadline)
+                breaker = self._breakers[agent_name] = CircuitBreaker(
+                    agent_name, deadline=deadline or None,
+                    failure_threshold=self.failure_threshold, reset_timeout=self.reset_timeout
+                )
+            return breaker
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {name: breaker.stats() for name, breaker in breakers.items()}
+
+# Threads that carry deadline-bounded LLM calls; a call abandoned at its deadline finishes here
+_llm_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('COPILOT_LLM_MAX_WORKERS', '32')),
+    thread_name_prefix='copilot-llm'
+)
+
+agent_breakers = CircuitBreakerRegistry.from_env()
+
+# Traffic class of the LLM calls made in this context: 'interactive' (default) or 'batch'
+_llm_priority = contextvars.ContextVar('copilot_llm_priority', default='interactive')
+
+def set_llm_priority(priority: str) -> contextvars.Token:
+    """Tag this context's LLM calls with a traffic class; returns a token for reset_llm_priority"""
+    if priority not in LLMScheduler.CLASSES:
+        raise ValueError(f"Unknown LLM priority: {priority}")
+    return _llm_priority.set(priority)
+
+def reset_llm_priority(token: contextvars.Token):
+    _llm_priority.reset(token)
+
+@contextmanager
+def llm_priority(priority: str):
+    """Tag the LLM calls made inside the block with a traffic class"""
+    token = set_llm_priority(priority)
+    try:
+        yield
+    finally:
+        reset_llm_priority(token)
+
+class LLMScheduler:
+    """Admit LLM calls to a fixed number of slots, interactive traffic first.
+    
+    Queued calls are dispatched by stride scheduling: each class advances by
+    1/weight per dispatch and the class that is furthest behind goes next, so
+    with weights 4:1 batch still gets every fifth free slot. Batch calls can
+    never hold the ``reserved_interactive`` slots, which keeps interactive
+    latency flat while batch saturates the rest. A capacity of 0 admits every
+    call immediately and only records metrics.
+    
+    Slots and priorities are per process: a preforking server splits the
+    capacity between its workers with ``share_among``.
+    """
+    
+    CLASSES = ('interactive', 'batch')
+    
+    class _Waiter:
+        def __init__(self):
+            self.ready = threading.Event()
+            self.enqueued_at = time.perf_counter()
+    
+    def __init__(self, capacity: int = 0, weights: Dict[str, float] = None, reserved_interactive: int = None):
+        self.weights = {'interactive': 4.0, 'batch': 1.0}
+        self.weights.update(weights or {})
+        self._reserved_setting = reserved_interactive
+        self._set_capacity(capacity, reserved_interactive)
+        self._lock = threading.Lock()
+        self._queues = {name: deque() for name in self.CLASSES}
+        self._running = {name: 0 for name in self.CLASSES}
+        self._pass = {name: 0.0 for name in self.CLASSES}
+        self._virtual_time = 0.0
+        self._waits = {name: deque(maxlen=1000) for name in self.CLASSES}
+        self._dispatched = {name: 0 for name in self.CLASSES}
+    
+    @classmethod
+    def from_env(cls) -> 'LLMScheduler':
+        """Build from COPILOT_LLM_CONCURRENCY, COPILOT_LLM_PRIORITY_WEIGHTS and COPILOT_LLM_RESERVED_INTERACTIVE"""
+        weights = {}
+        for item in os.getenv('COPILOT_LLM_PRIORITY_WEIGHTS', '').split(','):
+            if '=' in item:
+                name, weight = item.split('=', 1)
+                weights[name.strip()] = float(weight)
+        reserved = os.getenv('COPILOT_LLM_RESERVED_INTERACTIVE')
+        return cls(
+            capacity=int(os.getenv('COPILOT_LLM_CONCURRENCY', '0')),
+            weights=weights,
+            reserved_interactive=int(reserved) if reserved else None
+        )
+    
+    def _set_capacity(self, capacity: int, reserved_interactive: int = None):
+        self.capacity = capacity
+        if reserved_interactive is None:
+            reserved_interactive = max(1, capacity // 4) if capacity > 1 else 0
+        self.reserved_interactive = min(reserved_interactive, max(capacity - 1, 0))
+    
+    def share_among(self, workers: int):
+        """Keep this worker's share of the capacity, so workers together stay within it.
+        
+        Called once in each worker after fork. Every worker keeps at least one
+        slot, and interactive calls only take priority over batch calls in the
+        same worker.
+        """
+        if self.capacity <= 0 or workers <= 1:
+            return
+        with self._lock:
+            reserved = self._reserved_setting
+            self._set_capacity(max(1, self.capacity // workers),
+                               reserved // workers if reserved is not None else None)
+    
+    def _can_start(self, priority: str) -> bool:
+        if self.capacity <= 0:
+            return True
+        if sum(self._running.values()) >= self.capacity:
+            return False
+        return priority == 'interactive' or self._running['batch'] < self.capacity - self.reserved_interactive
+    
+    def _start(self, priority: str, waited: float):
+        self._running[priority] += 1
+        self._dispatched[priority] += 1
+        self._waits[priority].append(waited)
+    
+    def _dispatch(self):
+        """Hand free slots to queued calls, furthest-behind eligible class first"""
+        while True:
+            eligible = [name for name in self.CLASSES if self._queues[name] and self._can_start(name)]
+            if not eligible:
+                return
+            # Ties go to interactive, the first class
+            priority = min(eligible, key=lambda name: self._pass[name])
+            waiter = self._queues[priority].popleft()
+            self._virtual_time = self._pass[priority]
+            self._pass[priority] += 1.0 / self.weights[priority]
+            self._start(priority, time.perf_counter() - waiter.enqueued_at)
+            waiter.ready.set()
+    
+    def acquire(self, priority: str = None) -> str:
+        """Wait for a slot; returns the class it was granted under"""
+        priority = priority or _llm_priority.get()
+        with self._lock:
+            queued_ahead = self._queues[priority] or (priority == 'batch' and self._queues['interactive'])
+            if not queued_ahead and self._can_start(priority):
+                self._start(priority, 0.0)
+                return priority
+            if not self._queues[priority]:
+                # A class returning from idle doesn't get credit for the time it was away
+                self._pass[priority] = max(self._pass[priority], self._virtual_time)
+            waiter = self._Waiter()
+            self._queues[priority].append(waiter)
+        waiter.ready.wait()
+        return priority
+    
+    def release(self, priority: str):
+        with self._lock:
+            self._running[priority] -= 1
+            self._dispatch()
+    
+    @contextmanager
+    def slot(self, priority: str = None):
+        """Hold an LLM slot for the duration of the block"""
+        granted = self.acquire(priority)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Per-class queue depth, running calls and recent queue-wait percentiles"""
+        with self._lock:
+            classes = {}
+            for name in self.CLASSES:
+                waits = sorted(self._waits[name])
+                classes[name] = {
+                    'weight': self.weights[name],
+                    'queued': len(self._queues[name]),
+                    'running': self._running[name],
+                    'dispatched': self._dispatched[name],
+                    'wait_p50_ms': round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                    'wait_p95_ms': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0.0,
+                    'wait_max_ms': round(waits[-1] * 1000, 1) if waits else 0.0
+                }
+            return {
+                'capacity': self.capacity,
+                'reserved_interactive': self.reserved_interactive,
+                'classes': classes
+            }
+
+llm_scheduler = LLMScheduler.from_env()
+
+# LLM round trips still running, including ones abandoned at their deadline
+_active_llm_calls = 0
+_active_llm_lock = threading.Lock()
+
+class ResponseCache:
+    """Opt-in LRU cache of agent responses keyed by agent and rendered prompt.
+    
+    Enabled with COPILOT_RESPONSE_CACHE_SIZE (maximum entries, 0 disables)
+    and COPILOT_RESPONSE_CACHE_TTL (seconds an entry stays fresh). Only
+    successful LLM responses are stored, never degraded fallbacks.
+    """
+    
+    def __init__(self, max_entries: int = 0, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.prompt_chars = 0
+        self.response_chars = 0
+    
+    @classmethod
+    def from_env(cls) -> 'ResponseCache':
+        return cls(
+            max_entries=int(os.getenv('COPILOT_RESPONSE_CACHE_SIZE', '0')),
+            ttl=float(os.getenv('COPILOT_RESPONSE_CACHE_TTL', '3600'))
+        )
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+    
+    @staticmethod
+    def key_for(agent: str, prompt: str) -> str:
+        return hashlib.sha256(f"{agent}\0{prompt}".encode('utf-8')).hexdigest()
+    
+    def get(self, agent: str, prompt: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        key = self.key_for(agent, prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, agent: str, prompt: str, response: str):
+        if not self.enabled:
+            return
+        key = self.key_for(agent, prompt)
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, response)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            self.prompt_chars += len(prompt)
+            self.response_chars += len(response)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'prompt_chars': self.prompt_chars,
+                'response_chars': self.response_chars
+            }
+
+agent_response_cache = ResponseCache.from_env()
+
+# Optional record/replay layer for every agent LLM call, configured via COPILOT_CASSETTE
+_llm_cassette = LLMCassette.from_env()
+
+def get_llm_cassette() -> Optional[LLMCassette]:
+    """Return the active LLM cassette, if any"""
+    return _llm_cassette
+
+def set_llm_cassette(cassette: Optional[LLMCassette]):
+    """Install (or with None, remove) the cassette used by all agents"""
+    global _llm_cassette
+    _llm_cassette = cassette
+
+class BaseAgent:
+    """Common LLM call path shared by all agents"""
+    
+    def _run_chain(self, chain: LLMChain = None, **inputs) -> str:
+        """Run the agent's chain (or another of its chains), coalescing with any identical call already in flight"""
+        agent_name = type(self).__name__
+        chain = chain or self.chain
+        with span(f"{agent_name}.llm") as llm_span:
+            with span("prompt.render") as render_span:
+                rendered = chain.prompt.format(**inputs)
+                render_span.set('prompt_chars', len(rendered))
+            
+            cached = agent_response_cache.get(agent_name, rendered)
+            if cached is not None:
+                llm_span.set('cache', 'hit')
+                return cached
+            
+            def call_llm():
+                global _active_llm_calls
+                llm_span.set('coalesced', False)
+                with _active_llm_lock:
+                    _active_llm_calls += 1
+                try:
+                    return round_trip_llm()
+                finally:
+                    with _active_llm_lock:
+                        _active_llm_calls -= 1
+            
+            def round_trip_llm():
+                with span("llm.round_trip") as round_trip:
+                    cassette = _llm_cassette
+                    if cassette is not None and cassette.mode == 'replay':
+                        round_trip.set('cassette', 'replay')
+                        response = cassette.replay(agent_name, rendered)
+                    else:
+                        started = time.perf_counter()
+                        response = chain.run(**inputs)
+                        if cassette is not None:
+                            cassette.record(agent_name, rendered, response, time.perf_counter() - started)
+                    round_trip.set('response_chars', len(response))
+                    return response
+            
+            breaker = agent_breakers.get(agent_name)
+            
+            def dispatch():
+                # Only the single-flight leader takes a slot, and queueing doesn't eat into the deadline.
+                # An open breaker fails fast here rather than after waiting for a slot.
+                breaker.check_open()
+                with span("llm.queue") as queue_span:
+                    granted = llm_scheduler.acquire()
+                    queue_span.set('priority', granted)
+                started = []
+                
+                def call_in_slot():
+                    # Hold the slot until the call itself ends, even one abandoned at its deadline
+                    started.append(True)
+                    try:
+                        return call_llm()
+                    finally:
+                        llm_scheduler.release(granted)
+                
+                try:
+                    return breaker.call(call_in_slot)
+                finally:
+                    if not started:
+                        # Rejected by an open breaker before the call ran
+                        llm_scheduler.release(granted)
+            
+            llm_span.set('coalesced', True)
+            # Coalesce within a traffic class only, so interactive calls never wait on a queued batch leader
+            response = agent_singleflight.do((agent_name, rendered, _llm_priority.get()), dispatch)
+            agent_response_cache.put(agent_name, rendered, response)
+            return response
+    
+    def _record_fallback(self):
+        """Count a degraded result served instead of an LLM response"""
+        agent_breakers.get(type(self).__name__).record_fallback()
+
+class TopicAgent(BaseAgent):
     """Agent responsible for refining broad topics into specific research questions"""
     
     def __init__(self, llm):
@@ -73,13 +697,55 @@ class TopicAgent:
         """)
         
         self.chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        
+        # Recent refinements, served again while the LLM is unavailable
+        self._recent = OrderedDict()
+        self._recent_lock = threading.Lock()
+        self.recent_limit = 256
     
     def refine_topic(self, topic: str) -> Dict[str, Any]:
         """Refine a broad topic into specific research questions"""
         print(f"🔍 Topic Agent: Analyzing topic '{topic}'...")
         
-        response = self.chain.run(topic=topic)
-        
+        key = topic.strip().lower()
+        try:
+            response = self._run_chain(topic=topic)
+        except LLMUnavailableError as e:
+            print(f"⚠️ Topic Agent: {e}; serving a fallback")
+            self._record_fallback()
+            with self._recent_lock:
+                cached = self._recent.get(key)
+            return cached if cached is not None else self._heuristic_refinement(topic)
+        
+        with span("TopicAgent.parse", response_chars=len(response)):
+            result = self._parse_topic_response(response)
+        
+        with self._recent_lock:
+            self._recent[key] = result
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.recent_limit:
+                self._recent.popitem(last=False)
+        return result
+    
+    def _heuristic_refinement(self, topic: str) -> Dict[str, Any]:
+        """Generic starter questions for a topic when no LLM answer is available"""
+        return {
+            'research_questions': [
+                f"What are the main open challenges in {topic}?",
+                f"How have recent approaches to {topic} been evaluated, and what are their limitations?",
+                f"Which datasets, benchmarks or case studies best capture progress in {topic}?",
+                f"What practical or societal impact could advances in {topic} have?"
+            ],
+            'clarifying_questions': [
+                f"Which aspect of {topic} interests you most?",
+                "Are you planning an empirical, theoretical or survey paper?",
+                "Who is the intended audience for this paper?"
+            ],
+            'analysis': "The language model is temporarily unavailable, so these starter questions come from a template. Refine them or try again shortly."
+        }
+    
+    def _parse_topic_response(self, response: str) -> Dict[str, Any]:
+        """Parse the research questions, clarifying questions and analysis sections"""
         # Parse the response to extract research questions and clarifying questions
         questions = []
         clarifying = []
@@ -121,7 +787,26 @@ class TopicAgent:
         
         return responses
 
-class LiteratureAgent:
+@dataclass
+class LiteratureSearchResult:
+    """Merged outcome of a map-reduce literature search"""
+    suggestions: str
+    papers: List[Dict] = field(default_factory=list)
+    coverage: List[Dict] = field(default_factory=list)
+
+def normalize_title(title: str) -> str:
+    """Case- and punctuation-insensitive key used to spot the same paper twice"""
+    return re.sub(r'[^a-z0-9]+', ' ', title.lower()).strip()
+
+def format_user_preferences(clarifying_responses: Dict[str, Any]) -> str:
+    """Clarifying answers as the literature prompt's preference line.
+    
+    Blank answers are left out, so skipping the questions renders the same
+    prompt (and hits the same cached response) as answering none.
+    """
+    return " ".join(f"{k}: {str(v).strip()}" for k, v in clarifying_responses.items() if str(v).strip())
+
+class LiteratureAgent(BaseAgent):
     """Agent responsible for fetching and summarizing relevant papers"""
     
     def __init__(self, llm):
@@ -158,12 +843,38 @@ class LiteratureAgent:
         """)
         
         self.chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        
+        # Map step of the map-reduce search: a short query for a single research question
+        self.question_prompt = ChatPromptTemplate.from_template("""
+        You are an expert literature review specialist. Suggest 3-4 highly relevant papers for one research question.
+        
+        Topic: {topic}
+        Research Question: {research_question}
+        User Preferences: {user_preferences}
+        
+        Format your response as:
+        Paper: [Title]
+        Authors: [Authors]
+        Year: [Year]
+        Summary: [One or two sentences on the paper and why it answers the question]
+        
+        [Repeat for each paper, separated by a blank line]
+        """)
+        self.question_chain = LLMChain(llm=self.llm, prompt=self.question_prompt)
+        
+        # COPILOT_LITERATURE_MAP_REDUCE fans out one query per research question
+        self.map_reduce = os.getenv('COPILOT_LITERATURE_MAP_REDUCE', '').lower() in ('1', 'true', 'yes')
+        self.max_concurrency = int(os.getenv('COPILOT_LITERATURE_CONCURRENCY', '4'))
+        self.max_papers = 8
     
     def suggest_papers(self, topic: str, research_questions: List[str], user_preferences: str) -> str:
         """Suggest relevant papers based on research questions"""
         print(f"📚 Literature Agent: Researching relevant papers for '{topic}'...")
         
-        response = self.chain.run(
+        if self.map_reduce and len(research_questions) > 1:
+            return self.map_reduce_search(topic, research_questions, user_preferences).suggestions
+        
+        response = self._run_chain(
             topic=topic,
             research_questions="\n".join([f"- {q}" for q in research_questions]),
             user_preferences=user_preferences
@@ -171,6 +882,112 @@ class LiteratureAgent:
         
         return response
     
+    def map_reduce_search(self, topic: str, research_questions: List[str], user_preferences: str) -> LiteratureSearchResult:
+        """Query each research question concurrently, then merge and rank the papers.
+        
+        Papers are deduplicated by normalized title and ranked by how many
+        questions they serve, so wall time follows the slowest question
+        rather than one long generation for all of them.
+        """
+        with span("LiteratureAgent.map", questions=len(research_questions)):
+            workers = max(1, min(self.max_concurrency, len(research_questions)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copilot-literature') as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, self._search_question, topic, question, user_preferences)
+                    for question in research_questions
+                ]
+                outcomes = []
+                for future in futures:
+                    try:
+                        outcomes.append((future.result(), None))
+                    except Exception as e:
+                        outcomes.append(([], e))
+        
+        failures = [error for _, error in outcomes if error is not None]
+        if len(failures) == len(outcomes):
+            raise failures[0]
+        
+        with span("LiteratureAgent.reduce"):
+            merged = OrderedDict()
+            for number, (papers, _) in enumerate(outcomes, start=1):
+                for paper in papers:
+                    key = normalize_title(paper['title'])
+                    if not key:
+                        continue
+                    existing = merged.get(key)
+                    if existing is None:
+                        merged[key] = dict(paper, questions=[number])
+                        continue
+                    if number not in existing['questions']:
+                        existing['questions'].append(number)
+                    for name, value in paper.items():
+                        existing.setdefault(name, value)
+            
+            # Stable sort keeps first-seen order among papers serving as many questions
+            ranked = sorted(merged.values(), key=lambda paper: -len(paper['questions']))[:self.max_papers]
+            
+            coverage = []
+            for number, (question, (papers, error)) in enumerate(zip(research_questions, outcomes), start=1):
+                coverage.append({
+                    'question': question,
+                    'papers_found': len({normalize_title(paper['title']) for paper in papers}),
+                    'papers_selected': sum(1 for paper in ranked if number in paper['questions']),
+                    'error': str(error) if error is not None else None
+                })
+        
+        print(f"📚 Literature Agent: merged {len(merged)} unique papers from {len(research_questions)} questions")
+        return LiteratureSearchResult(
+            suggestions=self._format_suggestions(ranked, coverage),
+            papers=ranked,
+            coverage=coverage
+        )
+    
+    def _search_question(self, topic: str, question: str, user_preferences: str) -> List[Dict]:
+        response = self._run_chain(
+            chain=self.question_chain,
+            topic=topic,
+            research_question=question,
+            user_preferences=user_preferences
+        )
+        return self._parse_papers(response)
+    
+    def _parse_papers(self, response: str) -> List[Dict]:
+        """Parse "Paper:/Authors:/Year:/Summary:" blocks from a map response"""
+        papers = []
+        fields = {'authors': 'authors', 'author': 'authors', 'year': 'year', 'summary': 'summary', 'relevance': 'summary'}
+        for line in response.split('\n'):
+            line = line.strip().lstrip('-*').strip()
+            name, _, value = line.partition(':')
+            name = re.sub(r'[^a-z]', '', name.lower())
+            value = value.strip().strip('*').strip()
+            if not value:
+                continue
+            if name in ('paper', 'title') or re.fullmatch(r'paper\d*', name):
+                papers.append({'title': value.strip('"')})
+            elif papers and name in fields:
+                papers[-1].setdefault(fields[name], value)
+        return papers
+    
+    def _format_suggestions(self, papers: List[Dict], coverage: List[Dict]) -> str:
+        """Render merged papers in the same layout as a single-prompt suggestion"""
+        lines = ["PAPER_SUGGESTIONS:"]
+        for number, paper in enumerate(papers, start=1):
+            lines.append(f"Paper {number}: {paper['title']}")
+            lines.append(f"Authors: {paper.get('authors', 'Unknown')}")
+            if paper.get('year'):
+                lines.append(f"Year: {paper['year']}")
+            lines.append(f"Summary: {paper.get('summary', '')}")
+            lines.append(f"Relevance: Addresses research question(s) {', '.join(str(q) for q in paper['questions'])}")
+            lines.append("")
+        lines.append("COVERAGE:")
+        for number, item in enumerate(coverage, start=1):
+            status = f"failed ({item['error']})" if item['error'] else f"{item['papers_selected']} of {item['papers_found']} papers kept"
+            lines.append(f"- Question {number}: {status}")
+        lines.append("")
+        lines.append("SELECTION_GUIDE:")
+        lines.append("Select 3-5 papers, favouring those that address several research questions and covering every question at least once.")
+        return "\n".join(lines)
+    
     def get_user_paper_selection(self, paper_suggestions: str) -> List[int]:
         """Get user's paper selection"""
         print("\n📚 Literature Agent: Here are the suggested papers:")
@@ -186,7 +1003,7 @@ class LiteratureAgent:
             print("Invalid input. Please enter numbers separated by commas.")
             return self.get_user_paper_selection(paper_suggestions)
 
-class MethodologyAgent:
+class MethodologyAgent(BaseAgent):
     """Agent responsible for suggesting datasets, metrics, and experimental design"""
     
     def __init__(self, llm):
@@ -231,7 +1048,7 @@ class MethodologyAgent:
         # Mock paper data for now
         papers_text = "\n".join([f"- {paper.get('title', 'Paper')}" for paper in selected_papers])
         
-        response = self.chain.run(
+        response = self._run_chain(
             topic=topic,
             research_questions="\n".join([f"- {q}" for q in research_questions]),
             selected_papers=papers_text
@@ -262,7 +1079,7 @@ class MethodologyAgent:
         
         return preferences
 
-class DraftingAgent:
+class DraftingAgent(BaseAgent):
     """Agent responsible for creating LaTeX draft skeleton"""
     
     def __init__(self, llm):
@@ -293,19 +1110,25 @@ class DraftingAgent:
     def create_draft(self, topic, research_questions, selected_papers, methodology):
         """Create LaTeX draft skeleton"""
         try:
-            response = self.chain.run(
+            response = self._run_chain(
                 topic=topic,
                 research_questions=research_questions,
                 selected_papers=selected_papers,
                 methodology=methodology
             )
             
-            # Ensure the response starts with proper LaTeX document structure
-            if not response.strip().startswith('\\documentclass'):
-                # Create a proper LaTeX template if the AI response is incomplete
-                response = self._create_latex_template(topic, research_questions, selected_papers, methodology)
+            # Ensure the response is a structurally sound LaTeX document
+            validation = validate_latex(response)
+            if not validation.ok:
+                # Create a proper LaTeX template if the AI response can't compile
+                print(f"⚠️ Drafting Agent: LaTeX draft rejected ({'; '.join(validation.errors)}), using template")
+                return self._create_latex_template(topic, research_questions, selected_papers, methodology)
             
-            return response.strip()
+            return validation.document.strip()
+        except LLMUnavailableError as e:
+            print(f"⚠️ Drafting Agent: {e}; serving the template")
+            self._record_fallback()
+            return self._create_latex_template(topic, research_questions, selected_papers, methodology)
         except Exception as e:
             print(f"❌ Error in Drafting Agent: {e}")
             # Fallback to template
@@ -313,6 +1136,11 @@ class DraftingAgent:
     
     def _create_latex_template(self, topic, research_questions, selected_papers, methodology):
         """Create a fallback LaTeX template"""
+        with span("DraftingAgent.latex_template"):
+            return self._render_latex_template(topic, research_questions, selected_papers, methodology)
+    
+    def _render_latex_template(self, topic, research_questions, selected_papers, methodology):
+        """Assemble the fallback LaTeX document"""
         template = f"""\\documentclass[12pt,a4paper]{{article}}
 \\usepackage[utf8]{{inputenc}}
 \\usepackage[T1]{{fontenc}}
@@ -493,7 +1321,7 @@ We recommend the following areas for future investigation:
 \\bibitem{paper4} Author, D. (2024). Title of Paper 4. Conference Name, Pages.
 \\bibitem{paper5} Author, E. (2024). Title of Paper 5. Journal Name, Volume(Issue), Pages."""
 
-class PolishAgent:
+class PolishAgent(BaseAgent):
     """Agent responsible for rewriting sections in formal academic tone and formatting references"""
     
     def __init__(self, llm):
@@ -525,37 +1353,179 @@ class PolishAgent:
         """Polish the LaTeX draft for academic quality"""
         print(f"✨ Polish Agent: Polishing the LaTeX draft...")
         
-        response = self.chain.run(latex_draft=latex_draft)
-        
-        return response
+        try:
+            response = self._run_chain(latex_draft=latex_draft)
+        except LLMUnavailableError as e:
+            print(f"⚠️ Polish Agent: {e}; keeping the unpolished draft")
+            self._record_fallback()
+            return latex_draft
+        
+        # Never replace a sound draft with a polished version that can't compile
+        validation = validate_latex(response)
+        if not validation.ok:
+            print(f"⚠️ Polish Agent: polished LaTeX rejected ({'; '.join(validation.errors)}), keeping the draft")
+            return latex_draft
+        
+        return validation.document.strip()
 
-class ResearchCoPilot:
-    """Main orchestrator class that coordinates all agents"""
+class LLMPool:
+    """Process-wide LLM client and agents, built once and shared by every session.
+
+    The Gemini client keeps its HTTP connections alive between calls, so reusing
+    one client per process avoids paying connection and client setup on every
+    session. The agents only hold prompts and chains, which makes them safe to
+    share across request threads.
+    """
     
-    def __init__(self):
-        # Initialize LLM
-        api_key = os.getenv('GEMINI_API_KEY')
+    def __init__(self, api_key: str = None, model: str = None, temperature: float = 0.7):
+        api_key = api_key or os.getenv('GEMINI_API_KEY')
+        if not api_key and _llm_cassette is not None and _llm_cassette.mode == 'replay':
+            # Replayed sessions never reach Gemini, so no real key is needed
+            api_key = 'cassette-replay'
         if not api_key:
             raise ValueError("GEMINI_API_KEY not found in environment variables")
         
+        self.model = model or os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
+        client_kwargs = {}
+        endpoint = os.getenv('GEMINI_API_ENDPOINT')
+        if endpoint:
+            # Point the client at another Gemini-compatible server, e.g. the load-test stand-in
+            client_kwargs['client_options'] = {'api_endpoint': endpoint}
+            client_kwargs['transport'] = 'rest'
+        
         self.llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",
+            model=self.model,
             google_api_key=api_key,
-            temperature=0.7
+            temperature=temperature,
+            **client_kwargs
         )
         
-        # Initialize agents
+        # Agents are stateless apart from their chains, so one set serves all sessions
         self.topic_agent = TopicAgent(self.llm)
         self.literature_agent = LiteratureAgent(self.llm)
         self.methodology_agent = MethodologyAgent(self.llm)
         self.drafting_agent = DraftingAgent(self.llm)
         self.polish_agent = PolishAgent(self.llm)
         
-        # Research context
-        self.context = ResearchContext()
+        self.created_at = time.time()
+        self.warmed_up = False
+        self.last_probe_at = None
+        self.last_probe_ok = None
+        self.last_error = None
+        self._probe_lock = threading.Lock()
+        # A failed probe only counts for this long; after that readiness checks re-probe
+        self.probe_ttl = float(os.getenv('COPILOT_PROBE_TTL_SECONDS', '30'))
+        self._reprobing = threading.Event()
         
         print("🚀 Research Co-Pilot initialized successfully!")
     
+    def warm_up(self) -> bool:
+        """Issue a tiny LLM call so the first real request doesn't pay connection setup"""
+        ok = self.probe(max_age=0)
+        self.warmed_up = ok
+        if ok:
+            print("🔥 LLM pool warmed up")
+        else:
+            print(f"⚠️ LLM pool warm-up failed: {self.last_error}")
+        return ok
+    
+    def probe(self, max_age: float = 30.0) -> bool:
+        """Check the LLM round-trip, reusing the last result if it is recent enough"""
+        with self._probe_lock:
+            if self.last_probe_at is not None and time.time() - self.last_probe_at < max_age:
+                return self.last_probe_ok
+            try:
+                self.llm.invoke("Reply with the single word: ready")
+                self.last_probe_ok = True
+                self.last_error = None
+            except Exception as e:
+                self.last_probe_ok = False
+                self.last_error = str(e)
+            self.last_probe_at = time.time()
+            return self.last_probe_ok
+    
+    def _reprobe_in_background(self):
+        """Refresh a stale failed probe without blocking the readiness check that noticed it"""
+        if self._reprobing.is_set():
+            return
+        self._reprobing.set()
+        
+        def _run():
+            try:
+                self.probe(max_age=self.probe_ttl)
+            finally:
+                self._reprobing.clear()
+        
+        threading.Thread(target=_run, name='llm-reprobe', daemon=True).start()
+    
+    def health(self, deep: bool = False) -> Dict[str, Any]:
+        """Report pool readiness; a deep check performs a (cached) LLM probe.
+        
+        A failed probe keeps the pool unready only until it is re-probed: once
+        it is older than probe_ttl, the next check starts a new probe in the
+        background, so one failed warm-up can't mark the worker unready for good.
+        """
+        if deep:
+            self.probe(max_age=self.probe_ttl)
+        elif (self.last_probe_ok is False and self.last_probe_at is not None
+              and time.time() - self.last_probe_at >= self.probe_ttl):
+            self._reprobe_in_background()
+        return {
+            'ready': self.last_probe_ok is not False,
+            'model': self.model,
+            'warmed_up': self.warmed_up,
+            'uptime_seconds': round(time.time() - self.created_at, 1),
+            'last_probe_ok': self.last_probe_ok,
+            'last_error': self.last_error
+        }
+
+_llm_pool = None
+_llm_pool_lock = threading.Lock()
+
+def get_llm_pool() -> LLMPool:
+    """Return the process-wide LLM pool, creating it on first use"""
+    global _llm_pool
+    if _llm_pool is None:
+        with _llm_pool_lock:
+            if _llm_pool is None:
+                _llm_pool = LLMPool()
+    return _llm_pool
+
+def reset_llm_pool():
+    """Drop the process-wide LLM pool so the next caller builds a fresh one"""
+    global _llm_pool
+    with _llm_pool_lock:
+        _llm_pool = None
+
+def drain_llm_calls(timeout: float = 30.0) -> bool:
+    """Wait for in-flight LLM calls (including ones abandoned at their deadline) to finish"""
+    deadline = time.time() + timeout
+    while _active_llm_calls:
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+class ResearchCoPilot:
+    """Main orchestrator class that coordinates all agents"""
+    
+    def __init__(self, pool: LLMPool = None, context: ResearchContext = None):
+        # Reuse the shared LLM client and agents; only the context is per session
+        self.pool = pool or get_llm_pool()
+        self.llm = self.pool.llm
+        
+        self.topic_agent = self.pool.topic_agent
+        self.literature_agent = self.pool.literature_agent
+        self.methodology_agent = self.pool.methodology_agent
+        self.drafting_agent = self.pool.drafting_agent
+        self.polish_agent = self.pool.polish_agent
+        
+        # Research context
+        self.context = context or ResearchContext()
+        
+        # Background compile of the latest final_paper, if one was started
+        self.pdf_build = None
+    
     def run_research_workflow(self, broad_topic: str) -> str:
         """Execute the complete research workflow"""
         print(f"\n🎯 Starting Research Co-Pilot workflow for: {broad_topic}")
@@ -572,6 +1542,7 @@ class ResearchCoPilot:
             print(f"   {i}. {q}")
         
         # Get clarifying questions answered
+        clarifying_responses = {}
         if topic_results['clarifying_questions']:
             clarifying_responses = self.topic_agent.ask_clarifying_questions(
                 topic_results['clarifying_questions']
@@ -580,22 +1551,32 @@ class ResearchCoPilot:
         
         # Step 2: Literature Review
         print("\n📚 STEP 2: Literature Review")
-        user_preferences = " ".join([f"{k}: {v}" for k, v in clarifying_responses.items()])
-        paper_suggestions = self.literature_agent.suggest_papers(
-            broad_topic, 
-            self.context.research_questions, 
-            user_preferences
-        )
+        user_preferences = format_user_preferences(clarifying_responses)
+        if self.literature_agent.map_reduce and len(self.context.research_questions) > 1:
+            search = self.literature_agent.map_reduce_search(
+                broad_topic,
+                self.context.research_questions,
+                user_preferences
+            )
+            paper_suggestions = search.suggestions
+            self.context.suggested_papers = search.papers
+        else:
+            paper_suggestions = self.literature_agent.suggest_papers(
+                broad_topic, 
+                self.context.research_questions, 
+                user_preferences
+            )
+            self.context.suggested_papers = []
         
         # Get user paper selection
         selected_indices = self.literature_agent.get_user_paper_selection(paper_suggestions)
         
-        # Mock paper data based on selection
-        mock_papers = [
+        # Papers parsed by a map-reduce search, otherwise mock paper data based on selection
+        candidate_papers = self.context.suggested_papers or [
             {"title": f"Relevant Paper {i+1}", "authors": f"Author {i+1}", "summary": f"Summary {i+1}"}
             for i in range(8)
         ]
-        self.context.selected_papers = [mock_papers[i] for i in selected_indices]
+        self.context.selected_papers = [candidate_papers[i] for i in selected_indices if 0 <= i < len(candidate_papers)]
         
         print(f"✅ Selected {len(self.context.selected_papers)} papers for focus")
         
@@ -632,6 +1613,7 @@ class ResearchCoPilot:
         print("\n✨ STEP 5: Polish and Finalize")
         final_paper = self.polish_agent.polish_paper(draft_skeleton)
         self.context.final_paper = final_paper
+        self.start_pdf_build(eager=True)
         
         print("✅ Final polished LaTeX paper ready")
         
@@ -643,14 +1625,57 @@ class ResearchCoPilot:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"research_paper_{timestamp}.tex"
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(self.context.final_paper)
+        with span("save_paper", filename=filename, chars=len(self.context.final_paper)):
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(self.context.final_paper)
         
         print(f"💾 Paper saved to: {filename}")
         return filename
     
-    def generate_pdf(self, tex_filename):
+    def start_pdf_build(self, eager: bool = False):
+        """Compile final_paper in the background, superseding the build of an earlier revision.
+        
+        ``eager`` marks a build started right after polishing rather than for a
+        download; those are skipped when COPILOT_EAGER_PDF is off.
+        """
+        if eager and not pdf_builder.eager:
+            if self.pdf_build is not None:
+                pdf_builder.release(self.pdf_build)
+            self.pdf_build = None
+            return None
+        self.pdf_build = pdf_builder.submit(self.context.final_paper, self.generate_pdf, previous=self.pdf_build)
+        return self.pdf_build
+    
+    def current_pdf_build(self):
+        """The background build of the current final_paper, if there is one"""
+        build = self.pdf_build
+        if build is None or build.digest != pdf_builder.digest(self.context.final_paper or ''):
+            # Stateless requests don't carry the build, but may find it by the paper text
+            build = pdf_builder.get(self.context.final_paper)
+        return build if build is not None and build.status != CANCELLED else None
+    
+    def wait_for_pdf(self, timeout: float = 10.0):
+        """Path of the background-built PDF of final_paper, waiting up to timeout seconds; None if there isn't one"""
+        build = self.current_pdf_build()
+        return build.wait(timeout) if build is not None else None
+    
+    def generate_pdf(self, tex_filename, cancelled=None):
         """Generate PDF from LaTeX file using pdflatex"""
+        with span("generate_pdf", filename=tex_filename) as pdf_span:
+            result = self._compile_pdf(tex_filename, cancelled)
+            pdf_span.set('pdf', result.endswith('.pdf'))
+            return result
+    
+    def _compile_pdf(self, tex_filename, cancelled=None):
+        """Run pdflatex on tex_filename, twice only if references need it; returns the PDF path or the .tex path on failure"""
+        with open(tex_filename, 'r', encoding='utf-8') as f:
+            source = f.read()
+        validation = validate_latex(source, repair=False)
+        if not validation.ok:
+            # Don't spend pdflatex runs on a document that cannot compile
+            print(f"❌ LaTeX validation failed, skipping PDF build: {'; '.join(validation.errors)}")
+            return tex_filename
+        
         try:
             # Check if pdflatex is available
             result = subprocess.run(['which', 'pdflatex'], capture_output=True, text=True)
@@ -664,42 +1689,59 @@ class ResearchCoPilot:
                         print("❌ Failed to install texlive. PDF generation unavailable.")
                         return tex_filename
             
-            # Get the directory and filename without extension
+            # Absolute paths and cwd= rather than chdir, so concurrent builds can't move each other
+            tex_filename = os.path.abspath(tex_filename)
             base_dir = os.path.dirname(tex_filename)
             base_name = os.path.splitext(os.path.basename(tex_filename))[0]
+            pdf_filename = os.path.join(base_dir, f'{base_name}.pdf')
+            log_filename = os.path.join(base_dir, f'{base_name}.log')
+            # Same document with an end-of-dump marker, so the per-paper preamble lines still run against a format
+            format_source_filename = os.path.join(base_dir, f'{base_name}.fmtsrc.tex')
             
-            # Change to the directory containing the tex file
-            original_dir = os.getcwd()
-            os.chdir(base_dir)
+            def run_pdflatex(fmt):
+                if cancelled is not None and cancelled.is_set():
+                    # A superseded background build stops at the next pass
+                    raise PdfBuildCancelled()
+                command = ['pdflatex', '-interaction=nonstopmode', '-output-directory=' + base_dir, f'-jobname={base_name}']
+                if fmt:
+                    command.append(f'-fmt={fmt}')
+                    command.append(os.path.basename(format_source_filename))
+                else:
+                    command.append(f'{base_name}.tex')
+                return subprocess.run(command, cwd=base_dir, capture_output=True, text=True, timeout=60,
+                                      env=latex_formats.environment() if fmt else None)
             
             try:
-                # Run pdflatex twice to resolve references
-                print(f"🔧 Compiling LaTeX to PDF: {base_name}.tex")
+                if os.path.exists(pdf_filename):
+                    os.remove(pdf_filename)
+                
+                # A standard preamble is loaded from a precompiled format instead of re-reading every package
+                fmt = latex_formats.format_for(source)
+                if fmt:
+                    with open(format_source_filename, 'w', encoding='utf-8') as f:
+                        f.write(latex_formats.source_for_format(source))
+                print(f"🔧 Compiling LaTeX to PDF: {base_name}.tex" + (f" (format {fmt})" if fmt else ""))
                 
                 # First compilation
-                result = subprocess.run([
-                    'pdflatex', 
-                    '-interaction=nonstopmode', 
-                    '-output-directory=' + base_dir,
-                    f'{base_name}.tex'
-                ], capture_output=True, text=True, timeout=60)
+                result = run_pdflatex(fmt)
+                if fmt and not os.path.exists(pdf_filename):
+                    print(f"⚠️ Compiling with format {fmt} failed, retrying without it")
+                    result = run_pdflatex(None)
+                    if os.path.exists(pdf_filename):
+                        # The format itself was the problem (e.g. TeX was upgraded), so stop using it
+                        latex_formats.invalidate(fmt)
+                    fmt = None
                 
                 if result.returncode != 0:
                     print(f"⚠️ First pdflatex run had warnings: {result.stderr[:200]}...")
                 
-                # Second compilation to resolve references
-                result = subprocess.run([
-                    'pdflatex', 
-                    '-interaction=nonstopmode', 
-                    '-output-directory=' + base_dir,
-                    f'{base_name}.tex'
-                ], capture_output=True, text=True, timeout=60)
-                
-                if result.returncode != 0:
-                    print(f"⚠️ Second pdflatex run had warnings: {result.stderr[:200]}...")
+                # Second compilation only when the log says references are unresolved
+                if needs_rerun(log_filename):
+                    result = run_pdflatex(fmt)
+                    if result.returncode != 0:
+                        print(f"⚠️ Second pdflatex run had warnings: {result.stderr[:200]}...")
                 
                 # Check if PDF was created
-                pdf_filename = os.path.join(base_dir, f'{base_name}.pdf')
                 if os.path.exists(pdf_filename):
                     print(f"✅ PDF generated successfully: {pdf_filename}")
                     return pdf_filename
@@ -707,9 +1749,12 @@ class ResearchCoPilot:
                     print("❌ PDF file not found after compilation")
                     return tex_filename
                     
+            except PdfBuildCancelled:
+                print(f"⏹️ PDF build of {base_name}.tex cancelled")
+                return tex_filename
             finally:
                 # Clean up auxiliary files
-                aux_files = ['.aux', '.log', '.out', '.toc', '.lof', '.lot']
+                aux_files = ['.aux', '.log', '.out', '.toc', '.lof', '.lot', '.fmtsrc.tex']
                 for ext in aux_files:
                     aux_file = os.path.join(base_dir, f'{base_name}{ext}')
                     if os.path.exists(aux_file):
@@ -718,9 +1763,6 @@ class ResearchCoPilot:
                         except:
                             pass
                 
-                # Return to original directory
-                os.chdir(original_dir)
-                
         except subprocess.TimeoutExpired:
             print("❌ PDF generation timed out")
             return tex_filename
@@ -750,8 +1792,13 @@ def main():
         # Save the paper
         filename = copilot.save_paper()
         
-        # Try to generate PDF
-        pdf_filename = copilot.generate_pdf(filename)
+        # The PDF has been compiling in the background since the paper was polished
+        pdf_filename = copilot.wait_for_pdf(timeout=120)
+        if pdf_filename:
+            pdf_filename = shutil.copyfile(pdf_filename, os.path.splitext(filename)[0] + '.pdf')
+        else:
+            # Try to generate PDF
+            pdf_filename = copilot.generate_pdf(filename)
         
         print(f"\n🎉 Research Co-Pilot workflow completed!")
         print(f"📄 Final paper: {filename}")
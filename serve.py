@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Research Co-Pilot Production Server
+Serves the web app with a preforking gunicorn master: heavy modules are loaded
+once before forking, and each worker builds its own LLM clients after fork
+"""
+
+import os
+import sys
+import signal
+import argparse
+import multiprocessing
+
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+
+# Cache warming quota shared by all workers; created in the master before forking
+warm_budget = None
+
+def default_workers() -> int:
+    return int(os.getenv('COPILOT_WORKERS') or multiprocessing.cpu_count() * 2 + 1)
+
+def post_fork(server, worker):
+    """Give each worker fresh LLM clients and its share of the LLM slots; gRPC/HTTP connections must not cross a fork"""
+    from research_co_pilot import reset_llm_pool, llm_scheduler
+    reset_llm_pool()
+    # Schedulers are per process, so split COPILOT_LLM_CONCURRENCY instead of granting it to every worker
+    llm_scheduler.share_among(worker.cfg.workers)
+
+def post_worker_init(worker):
+    """Mark the worker as draining on SIGTERM, then start its background warm-ups"""
+    from co_pilot_web import draining, start_warmup
+    from cache_warmer import start_scheduled_warming
+    
+    handle_exit = worker.handle_exit
+    
+    def drain_then_exit(sig, frame):
+        draining.set()
+        handle_exit(sig, frame)
+    
+    signal.signal(signal.SIGTERM, drain_then_exit)
+    start_warmup()
+    # Each worker warms its own cache, but all of them draw on the one budget
+    start_scheduled_warming(shared_budget=warm_budget, workers=worker.cfg.workers)
+
+def worker_exit(server, worker):
+    """Let LLM calls that outlived their request finish before the worker goes away"""
+    from research_co_pilot import drain_llm_calls
+    if not drain_llm_calls(timeout=float(worker.cfg.graceful_timeout)):
+        worker.log.warning("Worker %s exiting with LLM calls still in flight", worker.pid)
+
+class CoPilotServer(BaseApplication):
+    """gunicorn application configured from code instead of a config file"""
+    
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+    
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+    
+    def load(self):
+        from co_pilot_web import app
+        return app
+
+def build_options(args) -> dict:
+    return {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        # Import co_pilot_web and LangChain once in the master so workers share them copy-on-write
+        'preload_app': True,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': 5,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10 if args.max_requests else 0,
+        'accesslog': '-' if args.access_log else None,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit
+    }
+
+def main(argv=None):
+    global warm_budget
+    # Read .env first: it supplies option defaults and decides the session mode below
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Serve Research Co-Pilot with multiple worker processes")
+    parser.add_argument('--bind', default=os.getenv('COPILOT_BIND', '0.0.0.0:5003'), help="Address to listen on")
+    parser.add_argument('--workers', type=int, default=default_workers(), help="Worker processes (default: 2 x cores + 1)")
+    parser.add_argument('--threads', type=int, default=int(os.getenv('COPILOT_THREADS', '8')),
+                        help="Threads per worker; LLM calls mostly wait on the network")
+    parser.add_argument('--timeout', type=int, default=int(os.getenv('COPILOT_WORKER_TIMEOUT', '180')),
+                        help="Seconds before a silent worker is restarted")
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.getenv('COPILOT_DRAIN_SECONDS', '120')),
+                        help="Seconds to drain in-flight requests and LLM calls on shutdown")
+    parser.add_argument('--max-requests', type=int, default=int(os.getenv('COPILOT_MAX_REQUESTS', '0')),
+                        help="Recycle a worker after this many requests (0 disables)")
+    parser.add_argument('--access-log', action='store_true', help="Write an access log to stdout")
+    args = parser.parse_args(argv)
+    
+    if args.workers > 1:
+        if 'COPILOT_STATELESS' not in os.environ:
+            # In-memory sessions live in one worker, so carry context in signed tokens instead.
+            # With preload, a generated token secret is created once and shared by every worker.
+            os.environ['COPILOT_STATELESS'] = '1'
+            print("ℹ️ Multiple workers: enabling stateless sessions (set COPILOT_STATELESS to override)")
+        elif os.environ['COPILOT_STATELESS'].lower() not in ('1', 'true', 'yes'):
+            print("⚠️ Sessions are kept per worker; route each client to one worker or enable COPILOT_STATELESS")
+        if os.environ['COPILOT_STATELESS'].lower() in ('1', 'true', 'yes') and not os.getenv('COPILOT_EAGER_PDF'):
+            # Background builds live in one worker, and the download may well land on another
+            os.environ['COPILOT_EAGER_PDF'] = '0'
+            print("ℹ️ Stateless workers: compiling PDFs on download instead of after polishing (set COPILOT_EAGER_PDF to override)")
+    
+    from cache_warmer import warming_enabled, shared_warm_budget
+    if warming_enabled():
+        warm_budget = shared_warm_budget()
+    
+    print(f"🚀 Serving Research Co-Pilot on {args.bind} with {args.workers} workers x {args.threads} threads")
+    CoPilotServer(build_options(args)).run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
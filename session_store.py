@@ -0,0 +1,366 @@
+"""
+Research Co-Pilot Session Store
+Keeps live research sessions within a global memory budget by compressing
+(and optionally spilling to disk) the large LaTeX fields of idle sessions,
+and by expiring sessions that were abandoned
+"""
+
+import os
+import sys
+import time
+import zlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any
+
+class _Entry:
+    """Bookkeeping for one stored session"""
+    
+    def __init__(self, copilot):
+        self.copilot = copilot
+        self.last_access = time.time()
+        self.active = 0
+        self.resident = 0
+        # field name -> ('zlib', bytes) or ('disk', path), plus the stored size
+        self.packed = {}
+        self.packed_sizes = {}
+        # Held while this session's fields are compressed, spilled or restored, so that
+        # work runs outside the store lock without racing a request for the same session
+        self.lock = threading.Lock()
+
+class SessionStore:
+    """Thread-safe session registry with a memory budget for large text fields.
+    
+    Sessions are checked out with acquire() and handed back with release().
+    Large fields of sessions that are not checked out are zlib-compressed once
+    they have been idle for a while or when resident plus compressed bytes
+    exceed the budget, and are transparently restored on the next acquire().
+    When a spill directory is configured, compressed fields beyond the budget
+    are written to disk. If that is still not enough, or a session has been
+    idle for ``ttl_seconds``, or there are more than ``max_sessions``, whole
+    sessions are evicted, least recently used first.
+    
+    Entries are kept in least-recently-used order, so each pass only visits
+    the sessions it acts on instead of sorting all of them. Budget passes run
+    on a background thread woken by add() and release(), and compression,
+    decompression and disk I/O happen outside the store-wide lock, so a
+    request only ever waits on work for its own session.
+    """
+    
+    LARGE_FIELDS = ('draft_skeleton', 'final_paper')
+    
+    def __init__(self, memory_budget_bytes: int = None, idle_seconds: float = None,
+                 spill_dir: str = None, min_field_bytes: int = 4096,
+                 ttl_seconds: float = None, max_sessions: int = None):
+        if memory_budget_bytes is None:
+            memory_budget_bytes = int(float(os.getenv('COPILOT_SESSION_MEMORY_MB', '256')) * 1024 * 1024)
+        if idle_seconds is None:
+            idle_seconds = float(os.getenv('COPILOT_SESSION_IDLE_SECONDS', '60'))
+        if spill_dir is None:
+            spill_dir = os.getenv('COPILOT_SESSION_SPILL_DIR') or None
+        if ttl_seconds is None:
+            ttl_seconds = float(os.getenv('COPILOT_SESSION_TTL_SECONDS', '7200'))
+        if max_sessions is None:
+            max_sessions = int(os.getenv('COPILOT_MAX_SESSIONS', '10000'))
+        
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_seconds = idle_seconds
+        self.spill_dir = spill_dir
+        self.min_field_bytes = min_field_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        # Serializes budget passes, which only take self._lock briefly between sessions
+        self._enforce_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._maintainer = None
+        # Every session, least recently used first
+        self._entries = OrderedDict()
+        # Idle sessions with uncompressed large fields, and sessions holding in-memory
+        # compressed fields, each least recently used first
+        self._packable = OrderedDict()
+        self._spillable = OrderedDict()
+        self._resident_bytes = 0
+        self._compressed_bytes = 0
+        self._spilled_bytes = 0
+        self.compressions = 0
+        self.spills = 0
+        self.restores = 0
+        self.expirations = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+    
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._entries
+    
+    def add(self, session_id: str, copilot):
+        """Register a new session"""
+        entry = _Entry(copilot)
+        with self._lock:
+            self._entries[session_id] = entry
+            self._refresh_resident(entry)
+            self._packable[session_id] = entry
+        self._schedule_maintenance()
+    
+    def acquire(self, session_id: str):
+        """Check out a session, restoring any packed fields; returns None if unknown"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            # Marked active first, so no budget pass starts packing it from here on
+            self._spillable.pop(session_id, None)
+            self._packable.pop(session_id, None)
+            entry.active += 1
+            entry.last_access = time.time()
+            self._entries.move_to_end(session_id)
+        if entry.packed:
+            self._unpack_entry(session_id, entry)
+        return entry.copilot
+    
+    def release(self, session_id: str):
+        """Hand a session back after a request and schedule a budget pass"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            entry.active = max(0, entry.active - 1)
+            entry.last_access = time.time()
+            self._entries.move_to_end(session_id)
+            # The request may have replaced the large fields, so re-measure them
+            self._refresh_resident(entry)
+            if entry.active == 0 and entry.resident:
+                self._packable[session_id] = entry
+                self._packable.move_to_end(session_id)
+        self._schedule_maintenance()
+    
+    def remove(self, session_id: str):
+        """Forget a session and any data it spilled to disk"""
+        with self._lock:
+            entry = self._remove_entry(session_id)
+        if entry is not None:
+            self._delete_spilled([entry])
+    
+    def enforce_budget(self):
+        """Expire abandoned sessions, compress idle ones and, while resident plus compressed
+        bytes are over budget, spill or evict the least recently used ones"""
+        with self._enforce_lock:
+            now = time.time()
+            
+            with self._lock:
+                # Entries are ordered by last access, so stop at the first one still within its TTL
+                expired = []
+                for session_id, entry in self._entries.items():
+                    if now - entry.last_access < self.ttl_seconds:
+                        break
+                    if entry.active == 0:
+                        expired.append(session_id)
+                removed = [self._remove_entry(session_id) for session_id in expired]
+                self.expirations += len(expired)
+            self._delete_spilled(removed)
+            
+            while True:
+                with self._lock:
+                    if not self._packable:
+                        break
+                    session_id, entry = next(iter(self._packable.items()))
+                    if now - entry.last_access < self.idle_seconds and not self._over_budget():
+                        break
+                    del self._packable[session_id]
+                self._pack_entry(session_id, entry)
+            
+            while self.spill_dir:
+                with self._lock:
+                    if not self._spillable or not self._over_budget():
+                        break
+                    session_id, entry = self._spillable.popitem(last=False)
+                self._spill_entry(session_id, entry)
+            
+            with self._lock:
+                # Last resort: drop whole sessions, skipping any a request still holds
+                excess_bytes = self._resident_bytes + self._compressed_bytes - self.memory_budget_bytes
+                excess_sessions = len(self._entries) - self.max_sessions
+                evicted = []
+                for session_id, entry in self._entries.items():
+                    if excess_bytes <= 0 and excess_sessions <= 0:
+                        break
+                    if entry.active:
+                        continue
+                    evicted.append(session_id)
+                    excess_sessions -= 1
+                    excess_bytes -= entry.resident + sum(
+                        size for field, size in entry.packed_sizes.items() if entry.packed[field][0] == 'zlib'
+                    )
+                removed = [self._remove_entry(session_id) for session_id in evicted]
+                self.evictions += len(evicted)
+            self._delete_spilled(removed)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Gauge of resident vs compressed vs spilled bytes"""
+        with self._lock:
+            return {
+                'sessions': len(self._entries),
+                'active_sessions': sum(1 for e in self._entries.values() if e.active),
+                'resident_bytes': self._resident_bytes,
+                'compressed_bytes': self._compressed_bytes,
+                'spilled_bytes': self._spilled_bytes,
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'max_sessions': self.max_sessions,
+                'compressions': self.compressions,
+                'spills': self.spills,
+                'restores': self.restores,
+                'expirations': self.expirations,
+                'evictions': self.evictions
+            }
+    
+    def _schedule_maintenance(self):
+        """Wake the budget thread, starting it on first use so each forked worker runs its own"""
+        if self._maintainer is None or not self._maintainer.is_alive():
+            with self._lock:
+                if self._maintainer is None or not self._maintainer.is_alive():
+                    self._maintainer = threading.Thread(target=self._maintain, name='session-store', daemon=True)
+                    self._maintainer.start()
+        self._wake.set()
+    
+    def _maintain(self):
+        # Also runs without traffic, so idle sessions are still compressed and expired
+        interval = max(1.0, min(self.idle_seconds, self.ttl_seconds))
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                self.enforce_budget()
+            except Exception as e:
+                print(f"⚠️ Session budget pass failed: {e}")
+    
+    def _pack_entry(self, session_id: str, entry: _Entry):
+        """Compress an idle session's large fields, outside the store lock"""
+        with entry.lock:
+            with self._lock:
+                if entry.active or self._entries.get(session_id) is not entry:
+                    return
+                context = entry.copilot.context
+                values = {field: getattr(context, field) for field in self.LARGE_FIELDS
+                          if field not in entry.packed and len(getattr(context, field)) >= self.min_field_bytes}
+            blobs = {field: zlib.compress(value.encode('utf-8')) for field, value in values.items()}
+            with self._lock:
+                # A request that checked the session out meanwhile is waiting on entry.lock
+                # and would restore the fields straight away, so don't bother
+                if entry.active or self._entries.get(session_id) is not entry:
+                    return
+                for field, blob in blobs.items():
+                    entry.packed[field] = ('zlib', blob)
+                    entry.packed_sizes[field] = len(blob)
+                    self._compressed_bytes += len(blob)
+                    setattr(context, field, "")
+                    self.compressions += 1
+                self._refresh_resident(entry)
+                if entry.packed and self.spill_dir:
+                    self._spillable[session_id] = entry
+    
+    def _spill_entry(self, session_id: str, entry: _Entry):
+        """Move a session's compressed fields to disk, outside the store lock"""
+        with entry.lock:
+            with self._lock:
+                if entry.active or self._entries.get(session_id) is not entry:
+                    return
+                blobs = {field: payload for field, (kind, payload) in entry.packed.items() if kind == 'zlib'}
+            paths = {}
+            for field, blob in blobs.items():
+                path = os.path.join(self.spill_dir, f"{session_id}.{field}.z")
+                with open(path, 'wb') as f:
+                    f.write(blob)
+                paths[field] = path
+            with self._lock:
+                registered = self._entries.get(session_id) is entry
+                if registered:
+                    for field, path in paths.items():
+                        entry.packed[field] = ('disk', path)
+                        self._compressed_bytes -= entry.packed_sizes[field]
+                        self._spilled_bytes += entry.packed_sizes[field]
+                        self.spills += 1
+            if not registered:
+                # Removed while writing; nothing refers to the files
+                for path in paths.values():
+                    self._remove_file(path)
+    
+    def _unpack_entry(self, session_id: str, entry: _Entry):
+        """Restore a checked-out session's packed fields, outside the store lock"""
+        with entry.lock:
+            values = {}
+            for field, (kind, payload) in entry.packed.items():
+                if kind == 'disk':
+                    with open(payload, 'rb') as f:
+                        payload = f.read()
+                values[field] = zlib.decompress(payload).decode('utf-8')
+            with self._lock:
+                for field, value in values.items():
+                    setattr(entry.copilot.context, field, value)
+                    self.restores += 1
+                if self._entries.get(session_id) is entry:
+                    self._forget_packed(entry)
+                    self._refresh_resident(entry)
+                spilled = [payload for kind, payload in entry.packed.values() if kind == 'disk']
+                entry.packed.clear()
+                entry.packed_sizes.clear()
+            for path in spilled:
+                self._remove_file(path)
+    
+    def _delete_spilled(self, entries):
+        """Delete the spill files of removed sessions, after any I/O on them has finished"""
+        for entry in entries:
+            if entry is None:
+                continue
+            with entry.lock:
+                for kind, payload in entry.packed.values():
+                    if kind == 'disk':
+                        self._remove_file(payload)
+                entry.packed.clear()
+                entry.packed_sizes.clear()
+    
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    
+    # Internal helpers; all of them expect self._lock to be held
+    
+    def _over_budget(self) -> bool:
+        # Spilled fields are on disk; everything else counts against the budget
+        return self._resident_bytes + self._compressed_bytes > self.memory_budget_bytes
+    
+    def _remove_entry(self, session_id: str):
+        """Unregister a session; its spill files are left to _delete_spilled"""
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return None
+        self._packable.pop(session_id, None)
+        self._spillable.pop(session_id, None)
+        self._resident_bytes -= entry.resident
+        self._forget_packed(entry)
+        return entry
+    
+    def _refresh_resident(self, entry: _Entry):
+        context = entry.copilot.context
+        size = sum(sys.getsizeof(getattr(context, field)) for field in self.LARGE_FIELDS
+                   if field not in entry.packed)
+        self._resident_bytes += size - entry.resident
+        entry.resident = size
+    
+    def _forget_packed(self, entry: _Entry):
+        """Take an entry's packed fields off the byte counters"""
+        for field, (kind, _) in entry.packed.items():
+            if kind == 'disk':
+                self._spilled_bytes -= entry.packed_sizes[field]
+            else:
+                self._compressed_bytes -= entry.packed_sizes[field]
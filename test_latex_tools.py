@@ -0,0 +1,32 @@
+"""
+Tests for the LaTeX validator's handling of verbatim-like content
+"""
+
+from latex_tools import validate_latex
+
+def _document(body: str) -> str:
+    return '\\documentclass{article}\n\\usepackage{listings}\n\\begin{document}\n' + body + '\n\\end{document}\n'
+
+def test_one_line_verbatim_with_percent():
+    result = validate_latex(_document('\\begin{verbatim}50%\\end{verbatim}'), repair=False)
+    assert result.ok, result.errors
+
+def test_multi_line_verbatim_with_braces_and_percent():
+    result = validate_latex(_document('\\begin{verbatim}\n{ 50% }\n}\n\\end{verbatim}'), repair=False)
+    assert result.ok, result.errors
+
+def test_lstinline_with_brace():
+    result = validate_latex(_document('Open a block with \\lstinline|{|.'), repair=False)
+    assert result.ok, result.errors
+
+def test_lstinline_with_options_and_brace():
+    result = validate_latex(_document('Close it with \\lstinline[language=C]!}!.'), repair=False)
+    assert result.ok, result.errors
+
+def test_verb_with_percent_and_brace():
+    result = validate_latex(_document('Use \\verb|%{| here.'), repair=False)
+    assert result.ok, result.errors
+
+def test_real_imbalance_still_reported():
+    result = validate_latex(_document('\\textbf{bold \\verb|}| text'), repair=False)
+    assert any('Unbalanced braces' in error for error in result.errors)
@@ -0,0 +1,66 @@
+"""
+Research Co-Pilot Text Deltas
+Compact line-based patches between two revisions of a document
+"""
+
+import re
+import json
+import hashlib
+from difflib import SequenceMatcher
+from typing import List, Optional
+
+# Lines including their newline; the browser splits with the same pattern
+_LINE_RE = re.compile(r'[^\n]*\n|[^\n]+\Z')
+
+def text_digest(text: str) -> str:
+    """Identifier a client uses to name the base revision it holds"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def split_lines(text: str) -> List[str]:
+    return _LINE_RE.findall(text)
+
+def make_delta(base: str, target: str) -> list:
+    """Describe target as edits to base.
+    
+    Ops are ``["=", n]`` (copy the next n base lines), ``["-", n]`` (skip the
+    next n base lines) and ``["+", text]`` (insert text). Counting lines rather
+    than characters keeps the patch independent of how the client measures
+    string length.
+    """
+    base_lines = split_lines(base)
+    target_lines = split_lines(target)
+    ops = []
+    matcher = SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(['=', i2 - i1])
+            continue
+        if i2 > i1:
+            ops.append(['-', i2 - i1])
+        if j2 > j1:
+            ops.append(['+', ''.join(target_lines[j1:j2])])
+    return ops
+
+def apply_delta(base: str, ops: list) -> str:
+    """Rebuild the target revision from base and a delta"""
+    base_lines = split_lines(base)
+    position = 0
+    parts = []
+    for op, value in ops:
+        if op == '=':
+            parts.extend(base_lines[position:position + value])
+            position += value
+        elif op == '-':
+            position += value
+        elif op == '+':
+            parts.append(value)
+        else:
+            raise ValueError(f"Unknown delta op: {op}")
+    return ''.join(parts)
+
+def compact_delta(base: str, target: str) -> Optional[list]:
+    """Delta of target against base, or None when sending target in full is no larger"""
+    ops = make_delta(base, target)
+    if len(json.dumps(ops, separators=(',', ':'))) >= len(json.dumps(target)):
+        return None
+    return ops
@@ -0,0 +1,166 @@
+"""
+Research Co-Pilot Tracing
+Lightweight span tracing for agents and routes, exported as JSONL timelines
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+# The span currently active in this thread / context
+_current_span = contextvars.ContextVar('copilot_current_span', default=None)
+
+class TraceConfig:
+    """Tracing settings, read from the environment.
+    
+    COPILOT_TRACE_FILE enables tracing and names the JSONL export file.
+    COPILOT_TRACE_SAMPLE_RATE keeps that fraction of traces (default 1.0), and
+    COPILOT_TRACE_SLOW_MS always keeps traces slower than the threshold.
+    """
+    
+    def __init__(self):
+        self.path = os.getenv('COPILOT_TRACE_FILE') or None
+        self.sample_rate = float(os.getenv('COPILOT_TRACE_SAMPLE_RATE', '1.0'))
+        slow_ms = os.getenv('COPILOT_TRACE_SLOW_MS')
+        self.slow_ms = float(slow_ms) if slow_ms else None
+    
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+config = TraceConfig()
+_export_lock = threading.Lock()
+
+class _Trace:
+    """All spans recorded for one root operation"""
+    
+    def __init__(self, sampled: bool):
+        self.trace_id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.spans = []
+        self.lock = threading.Lock()
+
+class Span:
+    """A timed operation within a trace"""
+    
+    def __init__(self, name: str, trace: _Trace, parent: Optional['Span'], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self._token = None
+    
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+    
+    def set(self, key: str, value: Any):
+        """Attach an attribute to the span"""
+        self.attributes[key] = value
+    
+    def finish(self, error: BaseException = None):
+        """End the span; ending a root span exports its trace"""
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start_perf
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        if self._token is not None:
+            try:
+                _current_span.reset(self._token)
+            except ValueError:
+                # Finished from a different context than it started in
+                pass
+            self._token = None
+        with self.trace.lock:
+            self.trace.spans.append(self)
+        if self.parent_id is None:
+            _export(self)
+    
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        record = {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'offset_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3)
+        }
+        if self.attributes:
+            record['attributes'] = self.attributes
+        if self.error:
+            record['error'] = self.error
+        return record
+
+class _NoopSpan:
+    """Stand-in returned when tracing is disabled"""
+    
+    trace_id = None
+    
+    def set(self, key, value):
+        pass
+    
+    def finish(self, error=None):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def start_span(name: str, **attributes):
+    """Start a span as a child of the current one, or as a new trace root"""
+    if not config.enabled:
+        return NOOP_SPAN
+    parent = _current_span.get()
+    if parent is None:
+        trace = _Trace(sampled=random.random() < config.sample_rate)
+    else:
+        trace = parent.trace
+    current = Span(name, trace, parent, attributes)
+    current._token = _current_span.set(current)
+    return current
+
+@contextmanager
+def span(name: str, **attributes):
+    """Context manager recording a span around the enclosed block"""
+    current = start_span(name, **attributes)
+    try:
+        yield current
+    except BaseException as e:
+        current.finish(error=e)
+        raise
+    current.finish()
+
+def current_trace_id() -> Optional[str]:
+    """Id of the trace active in this context, if any"""
+    current = _current_span.get()
+    return current.trace_id if current else None
+
+def _export(root: Span):
+    """Write a finished trace as one JSONL timeline if it was sampled or slow"""
+    trace = root.trace
+    slow = config.slow_ms is not None and root.duration * 1000 >= config.slow_ms
+    if not (trace.sampled or slow):
+        return
+    with trace.lock:
+        spans = sorted(trace.spans, key=lambda s: s.start)
+    record = {
+        'trace_id': trace.trace_id,
+        'name': root.name,
+        'start': root.start,
+        'duration_ms': round(root.duration * 1000, 3),
+        'sampled': trace.sampled,
+        'spans': [s.to_dict(root.start) for s in spans]
+    }
+    line = json.dumps(record, default=str)
+    with _export_lock:
+        with open(config.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')